@@ -0,0 +1,198 @@
+"""
+OAuth tokens shared by every sink of a run
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+from intuitlib.client import AuthClient
+
+try:
+    import fcntl
+except ImportError:
+    # File locks are only available on Unix, processes aren't coordinated elsewhere
+    fcntl = None
+
+TOKEN_KEYS = ("access_token", "refresh_token", "last_update")
+
+
+class TokenStore:
+    """Config file holding a realm's tokens, shared by every target process of that realm.
+
+    Refreshes happen while holding an exclusive lock on the file, and the file is
+    replaced atomically so other processes never read a partial config.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = f"{path}.lock"
+
+    @contextmanager
+    def locked(self):
+        with open(self.lock_path, "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def read(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable token store {self.path}: {e}")
+            return {}
+
+    def write(self, config):
+        # Write to a temporary file first so a crash never leaves a partial config
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(config, f, indent=4)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+
+class TokenManager:
+    """Access token of the run, refreshed by a background thread before it expires.
+
+    Refreshes are serialized so each refresh token is only used once, and callers
+    that saw the same token rejected share the one refresh that replaces it. With a
+    config file, refreshes are also serialized with the other processes of the realm
+    through its TokenStore, and tokens they refreshed are used instead of refreshing.
+    """
+
+    LIFETIME = 3600  # QBO access tokens last an hour
+    MARGIN = 300  # Refreshed 5 minutes before they expire
+    RETRY_DELAY = 30  # Wait after a failed background refresh
+
+    def __init__(self, config, config_file_path=None, transport=None, clock=time.time):
+        # The target's config, updated in place so the refreshed tokens are saved with it
+        self._config = config
+        self.config_file_path = config_file_path
+        self.transport = transport
+        self._clock = clock
+        self._auth_client = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def access_token(self):
+        return self._config.get("access_token")
+
+    @property
+    def refresh_token(self):
+        return self._config.get("refresh_token")
+
+    @property
+    def last_update(self):
+        return self._config.get("last_update")
+
+    @property
+    def token(self):
+        return {key: self._config.get(key) for key in TOKEN_KEYS}
+
+    @property
+    def store(self):
+        return TokenStore(self.config_file_path) if self.config_file_path else None
+
+    @property
+    def auth_client(self):
+        if self._auth_client is None:
+            self._auth_client = AuthClient(
+                self._config.get("client_id"),
+                self._config.get("client_secret"),
+                self._config.get("redirect_uri"),
+                "sandbox" if self._config.get("is_sandbox") else "production",
+            )
+            # Token refreshes reuse the target's connection pool
+            if self.transport is not None:
+                self.transport.mount(self._auth_client)
+        return self._auth_client
+
+    def expires_in(self):
+        """Seconds left until the token is due for a refresh."""
+        if not self.last_update:
+            return 0
+        return self.last_update + self.LIFETIME - self.MARGIN - self._clock()
+
+    def is_valid(self):
+        return self.expires_in() > 0
+
+    def ensure_valid(self):
+        """Refresh the token if it's due, unless another caller already did."""
+        with self._lock:
+            if self.is_valid():
+                return
+            self._refresh()
+        self.start()
+
+    def refresh(self, stale_token):
+        """Replace `stale_token`, unless another caller already did."""
+        with self._lock:
+            if stale_token != self.access_token:
+                return
+            self._refresh()
+        self.start()
+
+    def _refresh(self):
+        store = self.store
+        with store.locked() if store else nullcontext():
+            stored = store.read() if store else {}
+
+            # Another process of the realm refreshed the token while this one waited,
+            # its refresh token replaced the one this process has
+            if (stored.get("last_update") or 0) > (self.last_update or 0):
+                self._config.update({key: stored.get(key) for key in TOKEN_KEYS})
+                if self.is_valid():
+                    logging.info("Using the access token refreshed by another process")
+                    return
+
+            self.auth_client.refresh(self.refresh_token)
+            self._config["access_token"] = self.auth_client.access_token
+            self._config["refresh_token"] = self.auth_client.refresh_token
+            self._config["last_update"] = round(self._clock())
+            logging.info("Updated refresh token: {}".format(self.refresh_token))
+
+            # The rest of the stored config is kept as the other processes wrote it
+            if store:
+                store.write({**(stored or self._config), **self.token})
+
+    def adopt(self, token):
+        """Use `token`, refreshed by another process, if it's newer than the current one."""
+        with self._lock:
+            if token and token["last_update"] > (self.last_update or 0):
+                self._config.update(token)
+
+    def start(self):
+        """Refresh the token in the background from now on, ahead of its expiry."""
+        # Tokens of unknown age are refreshed by the first sink instead
+        if self._thread is not None or not self.last_update:
+            return
+        self._thread = threading.Thread(target=self._run, name="token-refresh", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while not self._stopped.wait(max(0.0, self.expires_in())):
+            try:
+                self.ensure_valid()
+            except Exception as e:
+                logging.warning(f"Failed to refresh the access token, retrying in {self.RETRY_DELAY}s: {e}")
+                self._stopped.wait(self.RETRY_DELAY)
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=1)
@@ -1,33 +1,91 @@
 import json
 import requests
-from datetime import datetime
-from intuitlib.client import AuthClient
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from singer_sdk.plugin_base import PluginBase
 from target_hotglue.client import HotglueBatchSink
 from typing import Dict, List, Optional
 import ast
+import time
+import uuid
+from datetime import datetime
 from target_quickbooks.util import save_api_usage
+from target_quickbooks.pipeline import BatchPipeline
+from target_quickbooks.reference import (
+    REFERENCE_ENTITIES,
+    REFERENCE_FIELDS,
+    ReferenceCollection,
+    apply_changes,
+    build_indexes,
+    compact_records,
+)
 from target_hotglue.rest import HGJSONEncoder
 
 class QuickbooksSink(HotglueBatchSink):
     endpoint = "/batch"
     max_size = 30  # Max records to write in one batch
+    stale_object_error = "5010"  # QBO error code for updates sent with an outdated SyncToken
+    rollback_failed_batches = True  # Delete the entities a batch posted when one of its records failed
+    lookup_chunk_size = 100  # Max ids per existence lookup query
+
+    # Reference collections used by the sink, loaded from the target cache on first access
+    reference_collections = ()
+
+    accounts = ReferenceCollection()
+    accounts_name = ReferenceCollection()
+    customers = ReferenceCollection()
+    items = ReferenceCollection()
+    categories = ReferenceCollection()
+    classes = ReferenceCollection()
+    tax_codes = ReferenceCollection()
+    currency = ReferenceCollection()
+    vendors = ReferenceCollection()
+    terms = ReferenceCollection()
+    sales_terms = ReferenceCollection()
+    customer_type = ReferenceCollection()
+    payment_methods = ReferenceCollection()
 
     @property
     def is_full(self):
-        # Checks if all records were already read
-        if self.name in self._target.target_counter:
-            all_records_were_read = self._total_records_read == self._target.target_counter[self.name]
-        elif self.stream_name in self._target.target_counter:
-            all_records_were_read = self._total_records_read == self._target.target_counter[self.stream_name]
-        else:
-            raise Exception(f"Stream name from record doesn't match schema. Name={self.name}, StreamName={self.stream_name}, TargetCounter={self._target.target_counter}")
+        # Checks if the max batch size was reached
+        if self.current_size >= self.batch_size:
+            return True
 
+        # Checks if the oldest record of the batch waited too long,
+        # the end of the input and STATE messages drain the batch as well
+        max_latency = self.config.get("batch_max_latency")
+        return bool(max_latency) and self.batch_age >= float(max_latency)
 
-        # Checks if the max batch size was reached
-        max_batch_size_reached = self._total_records_read % self.max_size == 0
+    @property
+    def batch_age(self):
+        # Seconds since the first record of the pending batch was read
+        if self._batch_started_at is None:
+            return 0.0
+        return time.monotonic() - self._batch_started_at
 
-        return all_records_were_read or max_batch_size_reached
+    def _after_process_record(self, context: dict) -> None:
+        if self._batch_started_at is None:
+            self._batch_started_at = time.monotonic()
+        super()._after_process_record(context)
+
+    def start_drain(self) -> dict:
+        self._batch_started_at = None
+        return super().start_drain()
+
+    @property
+    def batch_in_flight(self):
+        # Number of batch requests that can be sent at the same time
+        return max(1, int(self.config.get("batch_in_flight", 1)))
+
+    @property
+    def entity_in_flight(self):
+        # Requests to write single entities sent at once, QBO allows 10 concurrent requests per realm
+        return max(1, int(self.config.get("entity_in_flight", 4)))
+
+    @property
+    def batch_size(self):
+        # Enough records to fill every in-flight batch request
+        return self.max_size * self.batch_in_flight
 
     @property
     def base_url(self) -> str:
@@ -53,14 +111,15 @@ class QuickbooksSink(HotglueBatchSink):
     def __init__(self, target: PluginBase, stream_name: str, schema: Dict, key_properties: Optional[List[str]]) -> None:
         super().__init__(target, stream_name, schema, key_properties)
 
-        # Save config for refresh_token saving
-        self.config_file = target._config_file_path
-
         # Instantiate Client
         self.instantiate_client()
 
-        # Get reference data
-        self.get_reference_data()
+        # NOTE: Reference data is loaded lazily, see get_reference_data
+
+        # Writes batches in the background when pipelining is enabled, see process_batch
+        self.pipeline = None
+        # Time the first record of the pending batch was read, see is_full
+        self._batch_started_at = None
 
     def validate_input(self, record: dict):
         return True
@@ -77,99 +136,259 @@ class QuickbooksSink(HotglueBatchSink):
         return obj
 
     def instantiate_client(self):
-        self.last_refreshed = None
-        self.access_token = self.config.get("access_token")
-        self.refresh_token = self.config.get("refresh_token")
+        # Tokens are owned by the target so every sink uses the same one, see TokenManager
+        if not self.is_token_valid():
+            self.update_access_token()
+        self._target.tokens.start()
 
-        client_id = self.config.get("client_id")
-        client_secret = self.config.get("client_secret")
-        redirect_uri = self.config.get("redirect_uri")
+    @property
+    def access_token(self):
+        return self._target.tokens.access_token
 
-        if self.config.get("is_sandbox"):
-            environment = "sandbox"
-        else:
-            environment = "production"
+    @property
+    def refresh_token(self):
+        return self._target.tokens.refresh_token
+
+    @property
+    def auth_client(self):
+        return self._target.tokens.auth_client
+
+    def get_reference_data(self, *names):
+        """Load the sink's reference collections, plus any of `names` it didn't declare."""
+        # Reference data is owned by the target so every sink shares the same copy.
+        # Each entity type is fetched once and all of its collections are built from it.
+        names = set(self.reference_collections).union(names)
+
+        entity_types = [
+            entity_type
+            for entity_type, collections in REFERENCE_ENTITIES.items()
+            if names.intersection(collections)
+        ]
+        if not entity_types:
+            return
 
-        self.auth_client = AuthClient(
-            client_id, client_secret, redirect_uri, environment
+        errors = {}
+        loaded = self._target.reference_cache.get_many(
+            entity_types, lambda missing: self.load_reference_entities(missing, errors)
         )
 
-        if not self.is_token_valid():
-            self.update_access_token()
+        for indexes in loaded.values():
+            for name, index in indexes.items():
+                setattr(self, name, index)
 
-    def get_reference_data(self):
-        self.accounts = self.get_entities("Account", key="AcctNum")
-        self.accounts_name = self.get_entities("Account", key="Name")
-        self.customers = self.get_entities("Customer", key="DisplayName")
-        self.items = self.get_entities("Item", key="Name")
-        self.classes = self.get_entities("Class")
-        self.tax_codes = self.get_entities("TaxCode")
-        self.currency = self.get_entities("Currency")
-        self.vendors = self.get_entities("Vendor", key="DisplayName")
-        self.terms = self.get_entities("Term", key="Name")
-        self.customer_type = self.get_entities("CustomerType", key="Name")
-        self.payment_methods = self.get_entities("PaymentMethod", key="Name")
-        self.sales_terms = self.get_entities("Term")
-        self.categories = self.get_entities("Item", where_filter="Type='Category'")
+        if errors:
+            raise Exception(f"Failed to load reference data: {errors}")
 
-    def update_access_token(self):
-        self.auth_client.refresh(self.config.get("refresh_token"))
-        self.access_token = self.auth_client.access_token
-        self.refresh_token = self.auth_client.refresh_token
-        self._config["refresh_token"] = self.refresh_token
-        self.logger.info("Updated refresh token: {}".format(self.refresh_token))
-        self._config["access_token"] = self.access_token
-        self._config["last_update"] = round(datetime.now().timestamp())
+    def load_reference_entities(self, entity_types, errors):
+        """Build the indexes of `entity_types`, entity types that fail to load are added to `errors`."""
+        snapshot = self._target.reference_snapshot
+        records = {}
+
+        # Restore from the on-disk snapshot when enabled, only changes are downloaded
+        if snapshot is not None:
+            records.update(self.restore_reference_snapshot(entity_types))
+
+        missing = [entity_type for entity_type in entity_types if entity_type not in records]
+        if missing:
+            fetched_at = snapshot.timestamp() if snapshot is not None else None
+            fetched = {
+                entity_type: compact_records(entity_records)
+                for entity_type, entity_records in self.fetch_reference_entities(missing, errors).items()
+            }
+            records.update(fetched)
 
-        with open(self.config_file, "w") as outfile:
-            json.dump(self._config, outfile, indent=4)
+            if snapshot is not None and fetched:
+                snapshot.update(fetched, fetched_at)
+
+        return {
+            entity_type: build_indexes(records[entity_type], REFERENCE_ENTITIES[entity_type])
+            for entity_type in records
+        }
+
+    def fetch_reference_entities(self, entity_types, errors):
+        start = time.monotonic()
+
+        # Only select the fields the sinks read unless projections are disabled
+        fields = {}
+        if self.config.get("projection_queries", True):
+            fields = {e: REFERENCE_FIELDS[e] for e in entity_types if e in REFERENCE_FIELDS}
+
+        if self.config.get("batch_queries"):
+            # All entity types are queried together through /batch
+            try:
+                records = self.batch_fetch_entities(entity_types, fields=fields)
+            except Exception as e:
+                self.logger.error(f"Failed to load {', '.join(entity_types)} reference data after {time.monotonic() - start:.2f}s: {e}")
+                errors.update({entity_type: e for entity_type in entity_types})
+                return {}
+
+            for entity_type in entity_types:
+                self.logger.info(f"Loaded {len(records[entity_type])} {entity_type} reference records in {time.monotonic() - start:.2f}s")
+            return records
+
+        # Entity types load concurrently, the query slots keep the total number of
+        # requests (including concurrent pages) under QBO's per-realm limit
+        concurrency = min(int(self.config.get("reference_concurrency", 4)), len(entity_types))
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            futures = {
+                entity_type: executor.submit(
+                    self.fetch_entities, entity_type, fields=fields.get(entity_type)
+                )
+                for entity_type in entity_types
+            }
+
+        records = {}
+        for entity_type, future in futures.items():
+            try:
+                records[entity_type] = future.result()
+            except Exception as e:
+                self.logger.error(f"Failed to load {entity_type} reference data after {time.monotonic() - start:.2f}s: {e}")
+                errors[entity_type] = e
+                continue
+
+            self.logger.info(f"Loaded {len(records[entity_type])} {entity_type} reference records in {time.monotonic() - start:.2f}s")
+
+        return records
+
+    def restore_reference_snapshot(self, entity_types):
+        """Restore `entity_types` from the snapshot, applying the changes QBO captured since it was taken."""
+        snapshot = self._target.reference_snapshot
+        restorable = snapshot.restorable(entity_types)
+        if not restorable:
+            return {}
+
+        start = time.monotonic()
+        try:
+            with self._target.query_slots:
+                r = self.request_api(
+                    "GET",
+                    endpoint="/cdc",
+                    params={
+                        "entities": ",".join(restorable),
+                        # Snapshot times carry different offsets, the earliest instant covers them all
+                        "changedSince": min(restorable.values(), key=datetime.fromisoformat),
+                        "minorversion": "40",
+                    },
+                    headers={
+                        "Accept": "application/json",
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {self.access_token}",
+                    },
+                    stream="CDC"
+                )
+            response = r.json()
+        except Exception as e:
+            self.logger.warning(f"Failed to refresh the reference snapshot, fetching everything instead: {e}")
+            return {}
+
+        changes = {}
+        for cdc_response in response.get("CDCResponse") or []:
+            for query_response in cdc_response.get("QueryResponse") or []:
+                for entity_type in restorable:
+                    changes.setdefault(entity_type, []).extend(query_response.get(entity_type) or [])
+
+        records = {}
+        for entity_type in restorable:
+            entity_changes = changes.get(entity_type, [])
+            # CDC doesn't page, a full response may be missing changes
+            if len(entity_changes) >= snapshot.CDC_MAX_RESULTS:
+                self.logger.info(f"Too many {entity_type} changes since the snapshot, fetching everything instead")
+                continue
+
+            records[entity_type] = apply_changes(snapshot.records(entity_type), entity_changes)
+            self.logger.info(f"Restored {len(records[entity_type])} {entity_type} reference records ({len(entity_changes)} changed) in {time.monotonic() - start:.2f}s")
+
+        snapshot.update(records, response.get("time") or snapshot.timestamp())
+        return records
+
+    def update_access_token(self):
+        # Sinks that saw the token expire share one refresh
+        self._target.tokens.ensure_valid()
 
     def is_token_valid(self):
-        last_update = self.config.get("last_update")
-        if not last_update:
-            return False
-        if round(datetime.now().timestamp()) - last_update > 3300:  # 1h - 5min
-            return False
-        return True
+        return self._target.tokens.is_valid()
 
     def start_batch(self, context: dict) -> None:
+        # Tokens are refreshed in the background, this only waits when that refresh failed
         if not self.is_token_valid():
-            # If the token is invalid, refresh the access token
             self.update_access_token()
 
-    def search_reference_data(self, reference_data, key, value):
-        return_data = {}
-        for data in reference_data:
-            if key in data:
-                if isinstance(data,dict):
-                    if data[key] == value:
-                        return data
-                elif isinstance(data,str):
-                    if data==value:
-                        return data    
-        return return_data
-
     def get_entities(
         self, entity_type, key="Name", fallback_key="Name", check_active=True , where_filter=None
     ):
-        access_token = self.access_token
-        offset = 0
-        max = 100
         entities = {}
 
+        for record in self.fetch_entities(entity_type, check_active=check_active, where_filter=where_filter):
+            entity_key = record.get(key, record.get(fallback_key))
+            # Ignore None keys
+            if entity_key is None:
+                self.logger.warning(f"Failed to parse record f{json.dumps(record)}")
+                continue
+
+            entities[entity_key] = record
+
+        self.logger.debug(f"[get_entities]: Found {len(entities)} {entity_type}.")
+
+        return entities
+
+    def fetch_entities(self, entity_type, check_active=True, where_filter=None, fields=None):
+        page_size = int(self.config.get("page_size", 1000))
+        concurrency = int(self.config.get("query_concurrency", 4))
+
+        query = self.select_query(entity_type, fields)
+        if check_active:
+            query = query + " where Active=true"
+
+        if where_filter and check_active==False:
+            query = query + f" where {where_filter}"
+
+        # QBO positions are 1-based
+        entities = self.query_page(entity_type, query, 1, page_size)
+
+        # Everything fit in the first page
+        if len(entities) < page_size:
+            return entities
+
+        if concurrency > 1:
+            # Count the rows once and fetch the remaining windows concurrently,
+            # map() keeps the pages in position order so the merge is deterministic
+            total = self.query_count(entity_type, query)
+            positions = range(1 + page_size, total + 1, page_size)
+
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                pages = executor.map(
+                    lambda position: self.query_page(entity_type, query, position, page_size),
+                    positions,
+                )
+                for records in pages:
+                    entities.extend(records)
+
+            return entities
+
+        position = 1 + page_size
         while True:
-            query = f"select * from {entity_type}"
-            if check_active:
-                query = query + " where Active=true"
+            records = self.query_page(entity_type, query, position, page_size)
+            entities.extend(records)
+
+            # We're done - exit loop
+            if len(records) < page_size:
+                break
+
+            position += page_size
 
-            if where_filter and check_active==False:
-               query = query + f" where {where_filter}" 
-                
+        return entities
 
-            query = query + f" STARTPOSITION {offset} MAXRESULTS {max}"
+    def select_query(self, entity_type, fields=None):
+        """Return a select of `fields` (all of them by default) from `entity_type`."""
+        projection = ", ".join(fields) if fields else "*"
+        return f"select {projection} from {entity_type}"
 
-            self.logger.info(f"Fetch {entity_type}; url={self.base_url}; query {query}; minorversion 40")
-            
+    def query(self, entity_type, query):
+        access_token = self.access_token
+
+        self.logger.info(f"Fetch {entity_type}; url={self.base_url}; query {query}; minorversion 40")
+
+        with self._target.query_slots:
             r = self.request_api(
                 "GET",
                 endpoint="/query",
@@ -182,42 +401,249 @@ class QuickbooksSink(HotglueBatchSink):
                 stream=entity_type
             )
 
+        return r.json()["QueryResponse"]
 
-            response = r.json()
+    def query_page(self, entity_type, query, position, page_size):
+        response = self.query(
+            entity_type, f"{query} STARTPOSITION {position} MAXRESULTS {page_size}"
+        )
+        return self.parse_query_response(entity_type, response)
+
+    def parse_query_response(self, entity_type, response):
+        # No results
+        if not response.get("maxResults"):
+            return []
+
+        # Parse the results
+        try:
+            records = response[entity_type]
+        except KeyError:
+            records = response[f"Company{entity_type}"]
+
+        return records or []
+
+    def count_query(self, query):
+        # Swap the projection of the select for count(*)
+        return "select count(*)" + query[query.index(" from "):]
+
+    def query_count(self, entity_type, query):
+        response = self.query(entity_type, self.count_query(query))
+        return response.get("totalCount", 0)
+
+    def batch_query(self, queries):
+        """Run `queries` as /batch Query operations, returning their QueryResponse in order."""
+        responses = []
+
+        for i in range(0, len(queries), self.max_size):
+            chunk = queries[i : i + self.max_size]
+            self.logger.info(f"Batch query; url={self.base_url}; queries {chunk}; minorversion 40")
+
+            with self._target.query_slots:
+                r = self.request_api(
+                    "POST",
+                    endpoint="/batch",
+                    params={"minorversion": "40"},
+                    headers={
+                        "Accept": "application/json",
+                        "Content-Type": "application/json",
+                        "Authorization": f"Bearer {self.access_token}",
+                    },
+                    request_data={
+                        "BatchItemRequest": [
+                            {"bId": f"query{j}", "Query": query} for j, query in enumerate(chunk)
+                        ]
+                    },
+                    stream="Batch"
+                )
+
+            # Responses are not guaranteed to come back in request order
+            items = {item.get("bId"): item for item in r.json().get("BatchItemResponse") or []}
+            for j, query in enumerate(chunk):
+                item = items.get(f"query{j}", {})
+                if item.get("QueryResponse") is None:
+                    raise Exception(f"Batch query failed query={query} response={item.get('Fault', item)}")
+                responses.append(item["QueryResponse"])
+
+        return responses
+
+    def batch_fetch_entities(self, entity_types, check_active=True, fields=None):
+        """Fetch every record of `entity_types` with as few /batch calls as possible.
+
+        `fields` optionally maps entity types to the fields to select.
+        """
+        page_size = int(self.config.get("page_size", 1000))
+        entity_types = list(entity_types)
+        fields = fields or {}
+
+        queries = {}
+        for entity_type in entity_types:
+            query = self.select_query(entity_type, fields.get(entity_type))
+            if check_active:
+                query = query + " where Active=true"
+            queries[entity_type] = query
 
-            # Establish number of records returned.
-            count = response["QueryResponse"].get("maxResults")
+        # First round: the first page and the row count of every entity type
+        first_round = self.batch_query(
+            [f"{queries[e]} STARTPOSITION 1 MAXRESULTS {page_size}" for e in entity_types]
+            + [self.count_query(queries[e]) for e in entity_types]
+        )
+        entities = {
+            entity_type: self.parse_query_response(entity_type, response)
+            for entity_type, response in zip(entity_types, first_round)
+        }
+        totals = {
+            entity_type: response.get("totalCount", 0)
+            for entity_type, response in zip(entity_types, first_round[len(entity_types):])
+        }
 
-            # No results - exit loop.
-            if not count or count == 0:
-                break
+        # Second round: every remaining page of every entity type
+        windows = [
+            (entity_type, position)
+            for entity_type in entity_types
+            if len(entities[entity_type]) >= page_size
+            for position in range(1 + page_size, totals[entity_type] + 1, page_size)
+        ]
+        pages = self.batch_query(
+            [f"{queries[e]} STARTPOSITION {position} MAXRESULTS {page_size}" for e, position in windows]
+        )
+        for (entity_type, _), response in zip(windows, pages):
+            entities[entity_type].extend(self.parse_query_response(entity_type, response))
 
-            # Parse the results
-            try:
-                records = response["QueryResponse"][entity_type]
-            except KeyError:
-                records = response["QueryResponse"][f"Company{entity_type}"]
-
-            if not records:
-                records = []
-
-            # Append the results
-            for record in records:
-                entity_key = record.get(key, record.get(fallback_key))
-                # Ignore None keys
-                if entity_key is None:
-                    self.logger.warning(f"Failed to parse record f{json.dumps(record)}")
+        return entities
+
+    def lookup_sync_token(self, context, entity_type, entry, create_missing=False, missing_error=None):
+        """Defer the SyncToken lookup of the update `entry` to the rest of the batch.
+
+        Entries whose entity isn't found fail, are sent as creates with `create_missing`,
+        or raise `missing_error` when it's set.
+        """
+        context.setdefault("lookups", []).append((entity_type, entry, create_missing, missing_error))
+
+    def resolve_lookups(self, context):
+        """Resolve the deferred SyncToken lookups of the batch with one query per entity type."""
+        lookups = context.pop("lookups", [])
+        if not lookups:
+            return
+
+        # Optimistic updates use the SyncToken we already know, stale ones are retried after the write
+        if self.config.get("optimistic_updates"):
+            pending = []
+            for lookup in lookups:
+                entity_type, entry = lookup[:2]
+                sync_token = self.known_sync_token(entity_type, entry[1]["Id"])
+                if sync_token is None:
+                    pending.append(lookup)
                     continue
+                entry[1]["SyncToken"] = sync_token
+                context.setdefault("optimistic", {})[id(entry)] = entity_type
+            lookups = pending
 
-                entities[entity_key] = record
+        ids = {}
+        for entity_type, entry, *_ in lookups:
+            ids.setdefault(entity_type, set()).add(str(entry[1]["Id"]))
 
-            # We're done - exit loop
-            if count < max:
-                break
+        found = {
+            entity_type: self.fetch_by_ids(entity_type, sorted(entity_ids))
+            for entity_type, entity_ids in ids.items()
+        }
+
+        for entity_type, entry, create_missing, missing_error in lookups:
+            entity_id = entry[1]["Id"]
+            existing = found[entity_type].get(str(entity_id))
+            if existing:
+                entry[1]["SyncToken"] = existing["SyncToken"]
+            elif create_missing:
+                entry[2] = "create"
+            elif missing_error:
+                raise Exception(missing_error)
+            else:
+                # The record is reported as failed in the state instead of being written
+                error = f"{entry[0]} {entity_id} not found. Skipping..."
+                self.logger.warning(error)
+                entry[1:] = [{"error": error, "id": entity_id}, "error"]
+
+    def known_sync_token(self, entity_type, entity_id):
+        """Return the last SyncToken written or loaded for an entity, None if unknown."""
+        sync_token = self._target.sync_tokens.get((entity_type, str(entity_id)))
+        if sync_token is None:
+            record = self._target.reference_cache.by_id(entity_type, entity_id)
+            sync_token = record.get("SyncToken") if record else None
+        return sync_token
+
+    def remember_write(self, entity, record):
+        """Keep the reference data and known SyncTokens in sync with an entity QBO returned."""
+        self._target.reference_cache.write_through(entity, record)
+
+        key = (entity, str(record.get("Id")))
+        if record.get("status") == "Deleted":
+            self._target.sync_tokens.pop(key, None)
+        elif record.get("SyncToken") is not None:
+            self._target.sync_tokens[key] = record["SyncToken"]
+
+    def retry_stale_updates(self, records, response, entity_types):
+        """Refetch the SyncToken of optimistic updates that failed as stale and send them again.
+
+        `entity_types` maps the bId of each optimistic update to its entity type.
+        """
+        stale = [
+            item for item in response or []
+            if item.get("bId") in entity_types
+            and any(
+                str(error.get("code")) == self.stale_object_error
+                for error in (item.get("Fault") or {}).get("Error") or []
+            )
+        ]
+        if not stale:
+            return response
+
+        records = {record["bId"]: record for record in records}
+        retry = []
+        ids = {}
+        for item in stale:
+            record = records[item["bId"]]
+            payload = next(v for k, v in record.items() if k not in ["bId", "operation"])
+            retry.append((item["bId"], record, payload))
+            ids.setdefault(entity_types[item["bId"]], set()).add(str(payload["Id"]))
+
+        found = {
+            entity_type: self.fetch_by_ids(entity_type, sorted(entity_ids))
+            for entity_type, entity_ids in ids.items()
+        }
 
-            offset += max
+        batch_requests = []
+        for bid, record, payload in retry:
+            existing = found[entity_types[bid]].get(str(payload["Id"]))
+            # Entities deleted in the meantime keep their original error
+            if existing:
+                payload["SyncToken"] = existing["SyncToken"]
+                batch_requests.append(record)
 
-        self.logger.debug(f"[get_entities]: Found {len(entities)} {entity_type}.")
+        if not batch_requests:
+            return response
+
+        self.logger.info(f"Retrying {len(batch_requests)} updates with a stale SyncToken")
+        retried = {item.get("bId"): item for item in self.make_batch_request(batch_requests) or []}
+
+        return [retried.get(item.get("bId"), item) for item in response]
+
+    def fetch_by_ids(self, entity_type, ids):
+        """Return the Id and SyncToken of the `entity_type` entities in `ids`, keyed by Id."""
+        entities = {}
+
+        for i in range(0, len(ids), self.lookup_chunk_size):
+            chunk = ids[i : i + self.lookup_chunk_size]
+            where_filter = "Id in ({})".format(", ".join(f"'{entity_id}'" for entity_id in chunk))
+            # Queries only return active items unless asked otherwise
+            if entity_type == "Item":
+                where_filter += " and Active in (true, false)"
+
+            records = self.fetch_entities(
+                entity_type,
+                check_active=False,
+                where_filter=where_filter,
+                fields=("Id", "SyncToken"),
+            )
+            entities.update({str(record["Id"]): record for record in records})
 
         return entities
 
@@ -225,71 +651,68 @@ class QuickbooksSink(HotglueBatchSink):
         return {"bId": f"bid{index}", "operation": record[2], record[0]: record[1]}
 
     def process_batch(self, context: dict) -> None:
+        depth = int(self.config.get("pipeline_depth", 0))
+        if not depth:
+            self.write_batch(context)
+            return
+
+        # The batch is written in the background while the next one is mapped
+        if self.pipeline is None:
+            self.pipeline = BatchPipeline(depth, name=f"{self.name}-writer")
+        self.pipeline.submit(partial(self.write_batch, context))
+
+    def flush_pipeline(self):
+        """Wait for the batches written in the background, if any."""
+        if self.pipeline is not None:
+            self.pipeline.flush()
+
+    def clean_up(self) -> None:
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+        super().clean_up()
+
+    def write_batch(self, context: dict) -> None:
         # If the latest state is not set, initialize it
         if not self.latest_state:
             self.init_state()
-        
+
+        # Look up the SyncToken of every update of the batch at once
+        self.resolve_lookups(context)
+
         # Extract the raw records from the context
         raw_records = context.get("records", [])
 
         records = list(map(lambda e: self.process_batch_record(e[1], e[0]), enumerate(raw_records)))
 
-        if self.stream_name == "Customers":
-            # Build the URL to send the requests to
-            url = f"{self.base_url}/customer"
-            # Extract the "Customer" data from each record
-            list_data = [data["Customer"] for data in records]
-            # Send a separate request for each "Customer" data using map
-            response = map(lambda data: self.make_request(url,data, "Customer"), list_data)
-            # Handle the response for each request using the handle_response function
-            result = map(lambda response: self.handle_response(response), list(response))
-            # In case the response is successful and the record was marked as "InActive", update the record 
-            update_records = []
-            for data in records:
-                for res in response:
-                    if res["Customer"]["DisplayName"] == data["Customer"]["DisplayName"]:
-                        if data["operation"] == "create" and data["Customer"]["Active"] == False:
-                            data["operation"] = "update"
-                            data["Customer"]["Id"] = res["Customer"]["Id"]
-                            update_records.append(data)
-            if len(update_records) > 0:
-                # Send a separate request for each "Customer" data using map
-                update_records = [data["Customer"] for data in update_records]
-                response = map(lambda data: self.make_request(url,data, "Customer"), update_records)
-                # Handle the response for each request using the handle_response function
-                result_update = map(lambda response: self.handle_response(response), list(response))
-                # Update the latest state for each successful request
-                for state in list(result_update):
-                    self.update_state(state)
-               
-                
-            # Update the latest state for each successful request
-            for state in list(result):
-                self.update_state(state)
-
-
         # If the stream is "TaxRate", send a separate request for each record
-        elif self.stream_name == "TaxRate":
+        if self.name == "TaxRate":
             # Build the URL to send the requests to
             url = f"{self.base_url}/taxservice/taxcode"
             # Extract the "TaxService" data from each record
             list_data = [data["TaxService"] for data in records]
-            # Send a separate request for each "TaxService" data using map
-            response = map(lambda data: self.make_request(url,data, "TaxRate"), list_data)
-            # Handle the response for each request using the handle_response function
-            result = map(lambda response: self.handle_response(response), list(response))
-            # Update the latest state for each successful request
-            for state in list(result):
+            # Update the latest state for each request
+            for state in self.send_requests(url, list_data, "TaxRate"):
                 self.update_state(state)
         else:
-            # If the stream is not "TaxRate", send a single batch request for all records
+            # If the stream is not "TaxRate", send the records through batch requests
             original_records = records.copy()
             # only send the correctly mapped records to QBO
             records = [r for r in records if r["operation"] != "error"]
-            response = self.make_batch_request(records)
-            # Handle the batch response 
-            result = self.handle_batch_response(response)
-            state_updates = iter(result.get("state_updates", list()))
+            # Optimistic updates that were stale are retried with a fresh SyncToken
+            optimistic = context.pop("optimistic", {})
+            entity_types = {
+                f"bid{i}": optimistic[id(r)]
+                for i, r in enumerate(raw_records)
+                if id(r) in optimistic
+            }
+            states = self.send_batches(records, entity_types)
+
+            # Customers are always created active, the inactive ones are deactivated in a second batch
+            if self.name == "Customers":
+                states = self.deactivate_customers(records, states)
+
+            state_updates = iter(states)
 
             # Update the latest state for each state update in the response
             for i, r in enumerate(original_records):
@@ -299,21 +722,100 @@ class QuickbooksSink(HotglueBatchSink):
                 else:
                     self.update_state(next(state_updates, None))
 
+    def send_batches(self, records, entity_types=None):
+        """Write `records` through batch requests, returning their state updates in order."""
+        # Each batch request holds up to max_size records, several can be in flight at once
+        batches = [records[i : i + self.max_size] for i in range(0, len(records), self.max_size)]
+        results = self._target.transport.gather(
+            [partial(self.send_batch, batch, entity_types) for batch in batches],
+            self.batch_in_flight,
+        )
+        self.write_concurrency_metric("batch", self.batch_in_flight)
+        return [state for result in results for state in result.get("state_updates", list())]
+
+    def send_requests(self, url, list_data, stream=None):
+        """Write each of `list_data` with its own request, returning their state updates in order."""
+        # For the entities QBO doesn't take through /batch, up to entity_in_flight requests
+        # are sent at once, paced by the same rate limits as the batch requests
+        responses = self._target.transport.gather(
+            [partial(self.make_request, url, data, stream) for data in list_data],
+            self.entity_in_flight,
+            kind="entity",
+        )
+        self.write_concurrency_metric("entity", self.entity_in_flight)
+        return [self.handle_response(response) for response in responses]
+
+    def deactivate_customers(self, records, states):
+        """Deactivate the customers created from inactive records, returning the updated `states`."""
+        states = list(states)
+        updates = []
+        for i, (record, state) in enumerate(zip(records, states)):
+            customer = record["Customer"]
+            if record["operation"] != "create" or customer.get("Active") is not False:
+                continue
+            if not state or not state.get("success"):
+                continue
+            updates.append((i, {
+                "bId": record["bId"],
+                "operation": "update",
+                "Customer": {"Id": state["Id"], "SyncToken": state["SyncToken"], "Active": False, "sparse": True},
+            }))
+
+        if not updates:
+            return states
+
+        # The state of a deactivated customer is the one of its update
+        update_states = self.send_batches([update for _, update in updates])
+        for (i, _), state in zip(updates, update_states):
+            states[i] = state
+        return states
+
+    def write_concurrency_metric(self, kind, in_flight):
+        """Log the number of `kind` write calls currently allowed in flight as a Singer metric."""
+        metric = {
+            "type": "gauge",
+            "metric": "concurrency",
+            "value": self._target.transport.in_flight_limit(kind, in_flight),
+            "tags": {"stream": self.stream_name, "kind": kind},
+        }
+        self.logger.info(f"INFO METRIC: {json.dumps(metric)}")
+
+    def send_batch(self, batch_requests, entity_types=None):
+        """Write `batch_requests` in one batch request, returning the handled batch response."""
+        response = self.make_batch_request(batch_requests)
+        response = self.retry_stale_updates(batch_requests, response, entity_types or {})
+
+        # QBO doesn't guarantee the response order, states follow the request order
+        if response:
+            position = {r["bId"]: i for i, r in enumerate(batch_requests)}
+            response = sorted(response, key=lambda item: position.get(item.get("bId"), len(position)))
+
+        return self.handle_batch_response(response)
+
+    def request_id(self):
+        """New QBO requestid for a write, the transport reuses it when the write is retried."""
+        # Separate writes with the same content are still separate writes, so ids are never
+        # derived from the content, QBO would answer the later ones with the first response
+        return str(uuid.uuid4())
 
     def make_request(self, url, data, stream=None):
         access_token = self.access_token
+        body = json.dumps(data)
+        params = {"requestid": self.request_id()}
 
         # Send the request
-        r = requests.post(
+        r = self._target.transport.request(
+            "POST",
             url,
-            data=json.dumps(data),
+            params=params,
+            data=body,
             headers={
                 "Accept": "application/json",
                 "Content-Type": "application/json",
                 "Authorization": f"Bearer {access_token}",
             },
         )
-        save_api_usage("POST", url, {}, data, r, stream=stream)
+        save_api_usage("POST", url, params, data, r, stream=stream)
 
         response = r.json()
         self.logger.info(f"DEBUG RESPONSE: {response}")
@@ -346,11 +848,14 @@ class QuickbooksSink(HotglueBatchSink):
                 if not response.get(entity):
                     continue
                 record = response.get(entity)
+                self.remember_write(entity, record)
                 return {
                     "success": True,
                     "entityData": record,
                     "Id": record.get("Id"),
                 }
+            # Responses of other entities, e.g. TaxService, are returned as they are
+            return {"success": True, "entityData": response}
 
     def make_batch_request(self, batch_requests, params={}):
         access_token = self.access_token
@@ -361,8 +866,12 @@ class QuickbooksSink(HotglueBatchSink):
             "Authorization": f"Bearer {access_token}",
         }
 
+        # Copied so concurrent batches never share the default dict
+        params = dict(params)
         if not params.get("minorversion"):
             params["minorversion"] = "4"
+        # Retried batches are recognized by QBO and not written twice
+        params["requestid"] = self.request_id()
 
         r = self.request_api(
             "POST",
@@ -414,6 +923,8 @@ class QuickbooksSink(HotglueBatchSink):
                         continue
 
                     record = ri.get(entity)
+                    # Keep the shared reference data in sync so later sinks can use the entity
+                    self.remember_write(entity, record)
 
                     posted_records.append({
                         "Id": record.get("Id"),
@@ -423,7 +934,7 @@ class QuickbooksSink(HotglueBatchSink):
                         "success": True,
                     })
 
-        if failed:
+        if failed and self.rollback_failed_batches:
             batch_requests = []
             # In the event of failure, we need to delete the posted records
             for i, raw_record in enumerate(posted_records):
@@ -448,6 +959,11 @@ class QuickbooksSink(HotglueBatchSink):
             response = self.make_batch_request(batch_requests)
             self.logger.debug(json.dumps(response))
 
+            for ri in response or []:
+                for entity in entities:
+                    if ri.get(entity):
+                        self.remember_write(entity, ri[entity])
+
         def format_record(record: dict):
             record.pop("Entity", None)
             return record
@@ -475,7 +991,7 @@ class QuickbooksSink(HotglueBatchSink):
             else None
         )
 
-        response = requests.request(
+        response = self._target.transport.request(
             method=http_method,
             url=url,
             params=params,
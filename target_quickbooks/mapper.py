@@ -4,6 +4,7 @@ Functions to mapp from Hotglue's Unified Schema to the quickbooks' Schema
 import json
 import logging
 from datetime import datetime
+from target_quickbooks.reference import ReferenceIndex
 
 
 class EntityNotFoundException(Exception):
@@ -27,26 +28,28 @@ def evalable_list_objs(obj):
     
 
 def lookup_entity(record, id_field, name_field, entity, entity_list, required):
+    entity_list = ReferenceIndex.wrap(entity_list)
     entity_id = None
-    if record.get(id_field) in [v["Id"] for v in entity_list.values()]:
-        entity_id = record.get(id_field)
+    if entity_list.by_id(record.get(id_field)):
+        entity_id = entity_list.by_id(record.get(id_field))["Id"]
     elif record.get(name_field):
-        entity_id = entity_list.get(record.get(name_field), {}).get("Id")
+        entity_id = (entity_list.find(record.get(name_field)) or {}).get("Id")
     if not entity_id and required:
         raise EntityNotFoundException(f"Could not find {entity} in Quickbooks matching Id= {id_field} or Name={name_field}")
     return entity_id
 
 
 def lookup_entity_tuples(record, id_field_tuples, name_field_tuples, entity, entity_list, required):
+    entity_list = ReferenceIndex.wrap(entity_list)
     for ref_id_field, lookup_id_field in id_field_tuples:
         entity_id = record.get(lookup_id_field)
-        if entity_id and entity_id in [v[ref_id_field] for v in entity_list.values() if v.get(ref_id_field)]:
+        if entity_id and entity_list.lookup(ref_id_field, entity_id):
             return entity_id
 
     for ref_id_field, lookup_name_field in name_field_tuples:
         entity_name = record.get(lookup_name_field)
         if entity_name:
-            entity_id = entity_list.get(entity_name, {}).get(ref_id_field)
+            entity_id = (entity_list.find(entity_name) or {}).get(ref_id_field)
             if entity_id:
                 return entity_id
     if required:
@@ -247,9 +250,7 @@ def item_from_unified(record, tax_codes, categories):
         "invStartDate": "InvStartDate",
     }
 
-    categories = {
-        v["Name"]: v["Id"] for v in categories.values() if v["Type"] == "Category"
-    }
+    categories = ReferenceIndex.wrap(categories)
 
     item = dict(
         (mapp[key], value) for (key, value) in record.items() if key in mapp.keys()
@@ -293,10 +294,11 @@ def item_from_unified(record, tax_codes, categories):
         }
 
     if record.get("category"):
-        if record.get("category") in categories:
+        category = categories.find(record.get("category"))
+        if category and category.get("Type") == "Category":
             item["SubItem"] = True
             item["ParentRef"] = {
-                "value": categories[record.get("category")],
+                "value": category["Id"],
                 "name": record.get("category"),
             }
 
@@ -306,13 +308,14 @@ def item_from_unified(record, tax_codes, categories):
 def invoice_line(record, items, products, tax_codes=None):
     lines = []
     items = jsonable_list_objs(items)
+    products = ReferenceIndex.wrap(products)
 
     total_discount = 0
 
     for item in items:
         if not item.get("productName"):
             raise Exception(f"productName is empty, please review the payload")
-        product = products.get(item.get("productName"))
+        product = products.find(item.get("productName"))
         if not product:
             raise Exception(f"{item.get('productName')} is not a valid product in this Quickbooks company.")
         product_id = product["Id"]
@@ -582,9 +585,10 @@ def sales_receipt_line(record, items, products, tax_codes=None):
 def sales_receipt_from_unified(record, customers, products, tax_codes):
     customer_name = record.get("customerName",record.get("customer_name"))
     customer_id = None
+    customer = ReferenceIndex.wrap(customers).find(customer_name)
 
-    if customer_name and customers.get(customer_name):
-        customer_id = customers[customer_name]["Id"]
+    if customer:
+        customer_id = customer["Id"]
     else:
         logging.warn(f"Could not find matching customer for {customer_name}")
 
@@ -657,11 +661,12 @@ def sales_receipt_from_unified(record, customers, products, tax_codes):
 def credit_line(items, products, tax_codes=None):
     lines = []
     items = jsonable_list_objs(items)
+    products = ReferenceIndex.wrap(products)
 
     for item in items:
         if not item.get("productName"):
             raise Exception(f"productName is empty, please review the payload")
-        product = products.get(item.get("productName"))
+        product = products.find(item.get("productName"))
         if not product:
             raise Exception(f"{item.get('productName')} is not a valid product in this Quickbooks company.")
         product_id = product["Id"]
@@ -686,7 +691,11 @@ def credit_line(items, products, tax_codes=None):
 
 
 def creditnote_from_unified(record, customers, products, tax_codes):
-    customer_id = customers[record.get("customerRef").get("customerName")]["Id"]
+    customer_name = record.get("customerRef").get("customerName")
+    customer = ReferenceIndex.wrap(customers).find(customer_name)
+    if not customer:
+        raise EntityNotFoundException(f"Could not find Customer in Quickbooks matching Name={customer_name}")
+    customer_id = customer["Id"]
 
     invoice_lines = credit_line(record.get("lineItems"), products)
     # invoice_lines = invoice_line(record.get("lineItems"), products)
@@ -719,15 +728,16 @@ def department_from_unified(record):
     return department
 
 def deposit_from_unified(record, entity):
-    ref_accounts = entity.accounts
-    ref_classes = entity.classes
-    ref_customers = entity.customers
+    ref_accounts = ReferenceIndex.wrap(entity.accounts)
+    ref_accounts_name = ReferenceIndex.wrap(entity.accounts_name)
+    ref_classes = ReferenceIndex.wrap(entity.classes)
+    ref_customers = ReferenceIndex.wrap(entity.customers)
 
     qb_deposit = {
         "Line": [], 
         "DepositToAccountRef": {
             "name": record.get("accountName"), 
-            "value": ref_accounts.get(record.get("accountName"), {}).get("Id") if not record.get("accountId") else record.get("accountId"),
+            "value": (ref_accounts.find(record.get("accountName")) or {}).get("Id") if not record.get("accountId") else record.get("accountId"),
         },
         "TxnDate": record.get("issueDate"),
     }
@@ -743,19 +753,20 @@ def deposit_from_unified(record, entity):
             "DepositLineDetail": {
                 "AccountRef": {
                     "name": line_item.get("accountName"),
-                    "value": entity.accounts_name.get(line_item.get("accountName"), entity.accounts.get(line_item["accountName"], {})).get("Id"),
+                    "value": (ref_accounts_name.find(line_item.get("accountName")) or ref_accounts.find(line_item.get("accountName")) or {}).get("Id"),
                 },
                 "Entity": {
                     # TODO: this could be none value? or is better to not have Entity in that case?
                     "name": line_item.get("customerName"),
-                    "value": ref_customers.get(line_item.get("customerName"), {}).get("Id")
+                    "value": (ref_customers.find(line_item.get("customerName")) or {}).get("Id")
                 }
             }
         }
-        if ref_classes.get(line_item.get("className"), {}).get("Id", False):
+        class_ref = ref_classes.find(line_item.get("className"))
+        if class_ref and class_ref.get("Id"):
             content["DepositLineDetail"]["ClassRef"] = {
                 "name": line_item.get("className"),
-                "value": ref_classes.get(line_item.get("className"), {}).get("Id") if not line_item.get("classId") else line_item.get("classId")
+                "value": class_ref["Id"] if not line_item.get("classId") else line_item.get("classId")
             }
             
         qb_deposit["Line"].append(content)
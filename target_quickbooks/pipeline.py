@@ -0,0 +1,57 @@
+"""
+Background writing of a sink's batches while its next batch is being mapped
+"""
+import queue
+import threading
+
+
+class BatchPipeline:
+    """Runs the batches submitted by a sink one at a time, in order, on a background thread.
+
+    At most `depth` batches wait in the queue, submitting more blocks until one is sent.
+    The first error raised by a batch is raised again by the next `submit` or `flush`.
+    """
+
+    def __init__(self, depth=1, name=None):
+        self._queue = queue.Queue(maxsize=depth)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+
+    @property
+    def pending(self):
+        """Number of batches submitted that haven't finished yet."""
+        return self._queue.unfinished_tasks
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            try:
+                if work is None:
+                    return
+                # Batches after a failure are dropped, the error stops the run
+                if self._error is None:
+                    work()
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def submit(self, work):
+        self._raise_error()
+        self._queue.put(work)
+
+    def flush(self):
+        """Wait for every submitted batch to be sent."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
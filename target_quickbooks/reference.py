@@ -0,0 +1,406 @@
+"""
+Reference data (accounts, customers, items, ...) shared by every sink of a run
+"""
+import json
+import logging
+import os
+import tempfile
+import threading
+from collections.abc import Mapping
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Collections built from each QBO entity type.
+# name -> (key, Type filter), records missing the key fall back to their Name
+REFERENCE_ENTITIES = {
+    "Account": {
+        "accounts": ("AcctNum", None),
+        "accounts_name": ("Name", None),
+    },
+    "Customer": {"customers": ("DisplayName", None)},
+    "Item": {
+        "items": ("Name", None),
+        "categories": ("Name", "Category"),
+    },
+    "Class": {"classes": ("Name", None)},
+    "TaxCode": {"tax_codes": ("Name", None)},
+    "Currency": {"currency": ("Name", None)},
+    "Vendor": {"vendors": ("DisplayName", None)},
+    "Term": {
+        "terms": ("Name", None),
+        "sales_terms": ("Name", None),
+    },
+    "CustomerType": {"customer_type": ("Name", None)},
+    "PaymentMethod": {"payment_methods": ("Name", None)},
+}
+
+# Fields the sinks read from each entity type, reference queries only select these.
+# Entity types missing here are queried with select *
+REFERENCE_FIELDS = {
+    "Account": ("Id", "SyncToken", "Name", "FullyQualifiedName", "AcctNum", "AccountType", "Active"),
+    "Customer": ("Id", "SyncToken", "DisplayName", "FullyQualifiedName", "Active"),
+    "Item": (
+        "Id", "SyncToken", "Name", "FullyQualifiedName", "Sku", "Type",
+        "QtyOnHand", "TrackQtyOnHand", "Active",
+    ),
+    "Class": ("Id", "SyncToken", "Name", "FullyQualifiedName", "Active"),
+    "TaxCode": ("Id", "SyncToken", "Name", "Active"),
+    "Vendor": ("Id", "SyncToken", "DisplayName", "Active"),
+    "Term": ("Id", "SyncToken", "Name", "Active"),
+    "PaymentMethod": ("Id", "SyncToken", "Name", "Active"),
+}
+
+
+def normalize_name(name):
+    """Case and whitespace insensitive form of a reference name."""
+    return " ".join(str(name).split()).casefold()
+
+
+class ReferenceRecord:
+    """Read-only, dict-like record holding only the fields sinks read from reference data.
+
+    A record with `__slots__` takes a fraction of the memory of the full QBO payload.
+    """
+
+    __slots__ = (
+        "Id", "SyncToken", "Name", "DisplayName", "FullyQualifiedName", "AcctNum",
+        "AccountType", "Type", "Sku", "QtyOnHand", "TrackQtyOnHand", "Active",
+    )
+
+    def __init__(self, fields):
+        for field in self.__slots__:
+            setattr(self, field, fields.get(field))
+
+    @classmethod
+    def from_dict(cls, record):
+        """Compact a QBO record, records that are already compact are returned as is."""
+        if isinstance(record, cls):
+            return record
+        return cls(record)
+
+    def to_dict(self):
+        return {
+            field: getattr(self, field)
+            for field in self.__slots__
+            if getattr(self, field) is not None
+        }
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in self.__slots__ else None
+        return default if value is None else value
+
+    def __getitem__(self, field):
+        # Absent fields behave like missing dict keys
+        value = self.get(field)
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return self.get(field) is not None
+
+    def __repr__(self):
+        return f"ReferenceRecord({self.to_dict()})"
+
+
+class ReferenceIndex(Mapping):
+    """Reference records of one QBO entity type, hash-indexed on their lookup fields.
+
+    Behaves as a dict keyed by `key` (falling back to `fallback_key`) and resolves
+    records by Id, Name, DisplayName, AcctNum or normalized name without scanning.
+    """
+
+    INDEXED_FIELDS = ("Id", "Name", "DisplayName", "AcctNum")
+    NAME_FIELDS = ("Name", "DisplayName", "FullyQualifiedName")
+
+    def __init__(self, key="Name", fallback_key="Name"):
+        self.key = key
+        self.fallback_key = fallback_key
+        self._records = {}
+        self._indexes = {field: {} for field in self.INDEXED_FIELDS}
+        self._names = {}
+        # Writes can update the index from a background thread while sinks read it
+        self._lock = threading.RLock()
+
+    @classmethod
+    def wrap(cls, mapping):
+        """Return `mapping` as a ReferenceIndex, keeping the keys of plain dicts."""
+        if isinstance(mapping, cls):
+            return mapping
+
+        index = cls()
+        for entity_key, record in (mapping or {}).items():
+            index.add(record, entity_key)
+        return index
+
+    def __getitem__(self, entity_key):
+        return self._records[entity_key]
+
+    def __iter__(self):
+        return iter(self._records)
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, record, entity_key=None):
+        """Insert or replace `record` in every index, returns False if it has no key."""
+        if entity_key is None:
+            entity_key = record.get(self.key, record.get(self.fallback_key))
+        if entity_key is None:
+            return False
+
+        with self._lock:
+            # Drop the previous version first in case it was renamed
+            previous = self.by_id(record.get("Id"))
+            if previous is not None:
+                self.remove(previous)
+
+            self._records[entity_key] = record
+            for field, index in self._indexes.items():
+                value = record.get(field)
+                if value is not None:
+                    index[str(value)] = record
+            for field in self.NAME_FIELDS:
+                if record.get(field):
+                    self._names[normalize_name(record[field])] = record
+        return True
+
+    def remove(self, record):
+        """Remove `record` from every index."""
+        with self._lock:
+            entity_key = record.get(self.key, record.get(self.fallback_key))
+            if self._records.get(entity_key) is not record:
+                # Wrapped dicts may use keys that aren't a field of the record
+                entity_key = next((k for k, v in self._records.items() if v is record), None)
+            self._records.pop(entity_key, None)
+
+            for field, index in self._indexes.items():
+                value = record.get(field)
+                if value is not None and index.get(str(value)) is record:
+                    del index[str(value)]
+            for field in self.NAME_FIELDS:
+                name = normalize_name(record[field]) if record.get(field) else None
+                if name and self._names.get(name) is record:
+                    del self._names[name]
+
+    def lookup(self, field, value):
+        """Return the record whose `field` equals `value`, indexing `field` on first use."""
+        if value is None:
+            return None
+
+        index = self._indexes.get(field)
+        if index is None:
+            with self._lock:
+                index = {
+                    str(record[field]): record
+                    for record in self._records.values()
+                    if record.get(field) is not None
+                }
+                self._indexes[field] = index
+
+        return index.get(str(value))
+
+    def by_id(self, value):
+        return self.lookup("Id", value)
+
+    def find(self, name):
+        """Resolve `name` by key, Name or DisplayName, then by its normalized form."""
+        if not name:
+            return None
+
+        return (
+            self._records.get(name)
+            or self.lookup("Name", name)
+            or self.lookup("DisplayName", name)
+            or self._names.get(normalize_name(name))
+        )
+
+
+def build_indexes(records, collections, fallback_key="Name"):
+    """Build every collection of `collections` in a single pass over `records`."""
+    # Collections with the same definition share a single index
+    specs = {}
+    for name, spec in collections.items():
+        specs.setdefault(spec, []).append(name)
+
+    built = {spec: ReferenceIndex(spec[0], fallback_key) for spec in specs}
+
+    for record in records:
+        for (key, type_filter), index in built.items():
+            if type_filter and record.get("Type") != type_filter:
+                continue
+
+            # Ignore None keys
+            if not index.add(record):
+                logging.warning(f"Failed to parse record {record!r}")
+
+    return {name: built[spec] for spec, names in specs.items() for name in names}
+
+
+def compact_records(records):
+    """Convert QBO records to ReferenceRecords."""
+    return [ReferenceRecord.from_dict(record) for record in records]
+
+
+def apply_changes(records, changes):
+    """Apply change data capture results to `records`, dropping deleted and inactive entities."""
+    records = {record["Id"]: record for record in records}
+
+    for change in changes:
+        if change.get("status") == "Deleted" or change.get("Active") is False:
+            records.pop(change["Id"], None)
+        else:
+            records[change["Id"]] = ReferenceRecord.from_dict(change)
+
+    return list(records.values())
+
+
+class ReferenceSnapshot:
+    """On-disk copy of a realm's reference records, refreshed through QBO's change data capture."""
+
+    # CDC only looks back 30 days and returns at most 1000 changes per entity type
+    MAX_AGE = timedelta(days=30)
+    CDC_MAX_RESULTS = 1000
+    CDC_ENTITIES = ("Account", "Class", "Customer", "Item", "PaymentMethod", "Term", "Vendor")
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entities = {}
+
+        if self.path.exists():
+            try:
+                with open(self.path) as f:
+                    self._entities = json.load(f).get("entities", {})
+            except Exception as e:
+                logging.warning(f"Ignoring unreadable reference snapshot {self.path}: {e}")
+
+    @staticmethod
+    def timestamp():
+        return datetime.now(timezone.utc).isoformat()
+
+    def restorable(self, entity_types):
+        """Return the `entity_types` that can be restored, with the time they were taken at."""
+        oldest = datetime.now(timezone.utc) - self.MAX_AGE
+
+        with self._lock:
+            return {
+                entity_type: self._entities[entity_type]["changed_since"]
+                for entity_type in entity_types
+                if entity_type in self.CDC_ENTITIES
+                and entity_type in self._entities
+                and datetime.fromisoformat(self._entities[entity_type]["changed_since"]) > oldest
+            }
+
+    def records(self, entity_type):
+        with self._lock:
+            return compact_records(self._entities[entity_type]["records"])
+
+    def update(self, records, changed_since):
+        """Store the `records` of each entity type as of `changed_since` and save the snapshot."""
+        with self._lock:
+            for entity_type, entity_records in records.items():
+                self._entities[entity_type] = {
+                    "changed_since": changed_since,
+                    "records": entity_records,
+                }
+
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+
+            # Write to a temporary file first so a crash never leaves a partial snapshot
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"entities": self._entities}, f, default=ReferenceRecord.to_dict)
+                os.replace(tmp_path, self.path)
+            except Exception:
+                os.unlink(tmp_path)
+                raise
+
+
+class ReferenceCache:
+    """Target-level cache so each QBO entity type is fetched once per run."""
+
+    def __init__(self):
+        self._collections = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _lock_for(self, name):
+        with self._lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def get_many(self, names, loader):
+        """Return the collections `names`, loading the missing ones with one `loader(missing)` call.
+
+        `loader` returns a dict of the collections it loaded.
+        """
+        # Per-collection locks let different collections load at the same time while
+        # making sure the same one is never fetched twice. They're always taken in the
+        # same order to avoid deadlocks.
+        locks = [self._lock_for(name) for name in sorted(names)]
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            missing = [name for name in names if name not in self._collections]
+            if missing:
+                self._collections.update(loader(missing))
+        finally:
+            for lock in locks:
+                lock.release()
+
+        # Collections the loader couldn't load are left out
+        return {name: self._collections[name] for name in names if name in self._collections}
+
+    def by_id(self, entity_type, entity_id):
+        """Return the loaded `entity_type` record with `entity_id`, if any."""
+        indexes = self._collections.get(entity_type)
+        if not indexes:
+            return None
+        # The first collection of an entity type isn't filtered by Type
+        return next(iter(indexes.values())).by_id(entity_id)
+
+    def write_through(self, entity_type, record):
+        """Apply a record QBO returned for a write to the loaded collections of `entity_type`.
+
+        Entity types that aren't loaded yet are skipped, they'll include the record when fetched.
+        """
+        if entity_type not in REFERENCE_ENTITIES or record.get("Id") is None:
+            return
+
+        with self._lock_for(entity_type):
+            indexes = self._collections.get(entity_type)
+            if indexes is None:
+                return
+
+            # Reference data only holds active entities
+            removed = record.get("status") == "Deleted" or record.get("Active") is False
+            record = ReferenceRecord.from_dict(record)
+
+            for name, (key, type_filter) in REFERENCE_ENTITIES[entity_type].items():
+                index = indexes[name]
+                previous = index.by_id(record["Id"])
+                if previous is not None:
+                    index.remove(previous)
+                if removed or (type_filter and record.get("Type") != type_filter):
+                    continue
+                index.add(record)
+
+    def __contains__(self, name):
+        return name in self._collections
+
+
+class ReferenceCollection:
+    """Sink attribute that loads its reference collection the first time it's accessed."""
+
+    def __set_name__(self, owner, name):
+        self.name = name
+
+    def __get__(self, sink, owner=None):
+        if sink is None:
+            return self
+
+        # Loading stores the collection on the instance, which shadows this descriptor
+        sink.get_reference_data(self.name)
+        return sink.__dict__[self.name]
@@ -20,6 +20,7 @@ from target_quickbooks.mapper import (
 
 class InvoiceSink(QuickbooksSink):
     name = "Invoices"
+    reference_collections = ("customers", "items", "tax_codes", "sales_terms")
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -29,26 +30,9 @@ class InvoiceSink(QuickbooksSink):
             record, self.customers, self.items, self.tax_codes, self.sales_terms
         )
         if record.get("id"):
-            invoice_details = self.get_entities(
-                "Invoice",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}'",
-            )
-            if str(record.get("id")) in invoice_details:
-                invoice.update(
-                    {
-                        "Id": record.get("id"),
-                        "sparse": True,
-                        "SyncToken": invoice_details[str(record.get("id"))][
-                            "SyncToken"
-                        ],
-                    }
-                )
-                entry = ["Invoice", invoice, "update"]
-            else:
-                print(f"Invoice {record.get('id')} not found. Skipping...")
-                return
+            invoice.update({"Id": record.get("id"), "sparse": True})
+            entry = ["Invoice", invoice, "update"]
+            self.lookup_sync_token(context, "Invoice", entry)
         else:
             entry = ["Invoice", invoice, "create"]
 
@@ -59,6 +43,7 @@ class InvoiceSink(QuickbooksSink):
 
 class SalesReceiptSink(QuickbooksSink):
     name = "SalesReceipts"
+    reference_collections = ("customers", "items", "tax_codes")
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -71,26 +56,9 @@ class SalesReceiptSink(QuickbooksSink):
             self.tax_codes,
         )
         if record.get("id"):
-            receipt_details = self.get_entities(
-                "SalesReceipt",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}'",
-            )
-            if str(record.get("id")) in receipt_details:
-                sales_receipt.update(
-                    {
-                        "Id": record.get("id"),
-                        "sparse": True,
-                        "SyncToken": receipt_details[str(record.get("id"))][
-                            "SyncToken"
-                        ],
-                    }
-                )
-                entry = ["Sales Receipt", sales_receipt, "update"]
-            else:
-                print(f"Sales Receipt {record.get('id')} not found. Skipping...")
-                return
+            sales_receipt.update({"Id": record.get("id"), "sparse": True})
+            entry = ["Sales Receipt", sales_receipt, "update"]
+            self.lookup_sync_token(context, "SalesReceipt", entry)
         else:
             entry = ["SalesReceipt", sales_receipt, "create"]
 
@@ -101,6 +69,9 @@ class SalesReceiptSink(QuickbooksSink):
 
 class CustomerSink(QuickbooksSink):
     name = "Customers"
+    reference_collections = ("customers", "terms", "customer_type", "tax_codes", "payment_methods")
+    # Customers can't be deleted, each one is written or fails on its own
+    rollback_failed_batches = False
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -108,57 +79,34 @@ class CustomerSink(QuickbooksSink):
 
         customer = customer_from_unified(record)
 
-        if record.get("salesTerm") and record.get("salesTerm") in self.terms:
-            term = self.terms[record["salesTerm"]]
+        term = self.terms.find(record.get("salesTerm"))
+        if term:
             customer["SalesTermRef"] = {"value": term["Id"]}
 
         # Get Customer Type
-        if (
-            record.get("customerType")
-            and record.get("customerType") in self.customer_type
-        ):
-            customer_type = self.customer_type[record["customerType"]]
+        customer_type = self.customer_type.find(record.get("customerType"))
+        if customer_type:
             customer["CustomerTypeRef"] = {"value": customer_type["Id"]}
 
         # Get Tax Code
-        if record.get("taxCode") and record.get("taxCode") in self.tax_codes:
-            tax_code = self.tax_codes[record["taxCode"]]
+        tax_code = self.tax_codes.find(record.get("taxCode"))
+        if tax_code:
             customer["DefaultTaxCodeRef"] = {
                 "value": tax_code["Id"],
                 "name": tax_code["Name"],
             }
 
         # Get Payment Method
-        if (
-            record.get("paymentMethod")
-            and record.get("paymentMethod") in self.payment_methods
-        ):
-            pm = self.payment_methods[record["paymentMethod"]]
+        pm = self.payment_methods.find(record.get("paymentMethod"))
+        if pm:
             customer["PaymentMethodRef"] = {"value": pm["Id"], "name": pm["Name"]}
 
         if record.get("id"):
-            customer_details = self.get_entities(
-                "Customer",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}'",
-            )
-            if str(record.get("id")) in customer_details:
-                customer.update(
-                    {
-                        "Id": record.get("id"),
-                        "sparse": True,
-                        "SyncToken": customer_details[str(record.get("id"))][
-                            "SyncToken"
-                        ],
-                    }
-                )
-                entry = ["Customer", customer, "update"]
-            else:
-                print(f"Customer {record.get('id')} not found. Skipping...")
-                return
-        elif customer.get("DisplayName") in self.customers:
-            old_customer = self.customers[customer["DisplayName"]]
+            customer.update({"Id": record.get("id"), "sparse": True})
+            entry = ["Customer", customer, "update"]
+            self.lookup_sync_token(context, "Customer", entry)
+        elif self.customers.find(customer.get("DisplayName")):
+            old_customer = self.customers.find(customer["DisplayName"])
             customer["Id"] = old_customer["Id"]
             customer["SyncToken"] = old_customer["SyncToken"]
             customer["sparse"] = True
@@ -171,6 +119,7 @@ class CustomerSink(QuickbooksSink):
 
 class VendorSink(QuickbooksSink):
     name = "Vendors"
+    reference_collections = ("vendors", "tax_codes")
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -179,28 +128,11 @@ class VendorSink(QuickbooksSink):
         vendor = vendor_from_unified(record, self.tax_codes)
 
         if record.get("id"):
-            vendor_details = self.get_entities(
-                "Vendor",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}'",
-            )
-            if str(record.get("id")) in vendor_details:
-                vendor.update(
-                    {
-                        "Id": record.get("id"),
-                        "sparse": True,
-                        "SyncToken": vendor_details[str(record.get("id"))][
-                            "SyncToken"
-                        ],
-                    }
-                )
-                entry = ["Vendor", vendor, "update"]
-            else:
-                print(f"Vendor {record.get('id')} not found. Skipping...")
-                return
-        elif vendor.get("DisplayName") in self.vendors:
-            old_vendor = self.vendors[vendor["DisplayName"]]
+            vendor.update({"Id": record.get("id"), "sparse": True})
+            entry = ["Vendor", vendor, "update"]
+            self.lookup_sync_token(context, "Vendor", entry)
+        elif self.vendors.find(vendor.get("DisplayName")):
+            old_vendor = self.vendors.find(vendor["DisplayName"])
             vendor["Id"] = old_vendor["Id"]
             vendor["SyncToken"] = old_vendor["SyncToken"]
             vendor["sparse"] = True
@@ -215,6 +147,7 @@ class VendorSink(QuickbooksSink):
 
 class ItemSink(QuickbooksSink):
     name = "Items"
+    reference_collections = ("items", "categories", "tax_codes", "accounts", "accounts_name")
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -232,8 +165,7 @@ class ItemSink(QuickbooksSink):
 
         income_account = (
             self.accounts.get(income_account_num)
-            if self.accounts.get(income_account_num)
-            else self.accounts_name.get(income_account_num)
+            or self.accounts_name.find(income_account_num)
         )
 
         if income_account:
@@ -243,8 +175,7 @@ class ItemSink(QuickbooksSink):
 
         expense_account = (
             self.accounts.get(expense_account_num)
-            if self.accounts.get(expense_account_num)
-            else self.accounts_name.get(expense_account_num)
+            or self.accounts_name.find(expense_account_num)
         )
 
         if expense_account:
@@ -253,7 +184,7 @@ class ItemSink(QuickbooksSink):
         # Pick up account information from invoiceItem
         if not income_account and not expense_account and record.get("invoiceItem"):
             invoice_item = self.parse_objs(record.get("invoiceItem"))
-            account_detail = self.accounts_name.get(invoice_item.get("accountName"))
+            account_detail = self.accounts_name.find(invoice_item.get("accountName"))
 
             if account_detail is None:
                 raise Exception(
@@ -266,41 +197,12 @@ class ItemSink(QuickbooksSink):
                 item["ExpenseAccountRef"] = {"value": account_detail["Id"]}
 
         if record.get("id"):
-            item_details = self.get_entities(
-                "Item",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}'",
-            )
-            item_details_deleted = self.get_entities(
-                "Item",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}' and Active=false",
-            )
-
-            if item_details or item_details_deleted:
-                if item_details:
-                    item_previous = [x for x in item_details.values()]
-                    item_previous = item_previous[0]
-                else:
-                    item_previous = [x for x in item_details_deleted.values()]
-                    item_previous = item_previous[0]
-                if str(record.get("id")) == item_previous["Id"]:
-                    item.update(
-                        {
-                            "Id": record.get("id"),
-                            "sparse": True,
-                            "SyncToken": item_previous["SyncToken"],
-                        }
-                    )
-                    entry = ["Item", item, "update"]
-            else:
-                print(f"Item {record.get('id')} not found. Skipping...")
-                return
-
-        elif item["Name"] in self.items:
-            old_item = self.items[item["Name"]]
+            # Inactive items are looked up as well
+            item.update({"Id": record.get("id"), "sparse": True})
+            entry = ["Item", item, "update"]
+            self.lookup_sync_token(context, "Item", entry)
+        elif self.items.find(item["Name"]):
+            old_item = self.items.find(item["Name"])
             item["Id"] = old_item["Id"]
             item["SyncToken"] = old_item["SyncToken"]
             entry = ["Item", item, "update"]
@@ -312,6 +214,7 @@ class ItemSink(QuickbooksSink):
 
 class CreditNoteSink(QuickbooksSink):
     name = "CreditNotes"
+    reference_collections = ("customers", "items", "tax_codes")
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -380,6 +283,7 @@ class DepartmentSink(QuickbooksSink):
 
 class JournalEntrySink(QuickbooksSink):
     name = "JournalEntries"
+    reference_collections = ("accounts", "classes", "customers", "vendors")
 
     def process_record(self, record: dict, context: dict) -> None:
         if not context.get("records"):
@@ -410,8 +314,8 @@ class JournalEntrySink(QuickbooksSink):
             acct_ref = row.get("accountId")
 
             if acct_name and not acct_ref:
-                acct_ref = self.accounts.get(
-                    acct_num, self.accounts.get(acct_name, {})
+                acct_ref = (
+                    self.accounts.get(acct_num) or self.accounts_name.find(acct_name) or {}
                 ).get("Id")
 
             if acct_ref is not None:
@@ -427,7 +331,7 @@ class JournalEntrySink(QuickbooksSink):
 
             # Get the Quickbooks Class Ref
             class_name = row.get("className")
-            class_ref = self.classes.get(class_name, {}).get("Id")
+            class_ref = (self.classes.find(class_name) or {}).get("Id")
 
             if class_ref is not None:
                 je_detail["ClassRef"] = {"value": class_ref}
@@ -438,7 +342,7 @@ class JournalEntrySink(QuickbooksSink):
 
             # Get the Quickbooks Customer Ref
             customer_name = row.get("customerName")
-            customer_ref = self.customers.get(customer_name, {}).get("Id")
+            customer_ref = (self.customers.find(customer_name) or {}).get("Id")
 
             if customer_ref is not None:
                 je_detail["Entity"] = {
@@ -452,7 +356,7 @@ class JournalEntrySink(QuickbooksSink):
 
             # Get the Quickbooks Vendor Ref
             vendor_name = row.get("vendorName")
-            vendor_ref = self.vendors.get(vendor_name, {}).get("Id")
+            vendor_ref = (self.vendors.find(vendor_name) or {}).get("Id")
 
             if vendor_ref is not None:
                 je_detail["Entity"] = {
@@ -500,21 +404,11 @@ class JournalEntrySink(QuickbooksSink):
 
 class BillSink(QuickbooksSink):
     name = "Bills"
+    reference_collections = ("vendors", "items", "tax_codes", "classes", "accounts")
 
     def process_record(self, record: dict, context: dict) -> None:
         # Bill id
         bill_id = record.get("id")
-        updating_bill = False
-        if bill_id:
-            bill_details = self.get_entities(
-                "Bill",
-                check_active=False,
-                fallback_key="Id",
-                where_filter=f" id ='{record.get('id')}'",
-            )
-
-            if bill_details:
-                updating_bill = True
 
         if not context.get("records"):
             context["records"] = []
@@ -533,14 +427,15 @@ class BillSink(QuickbooksSink):
         #         }
 
         if "vendorName" in record:
-            if record["vendorName"] in self.vendors:
-                vendor = self.vendors[record["vendorName"]]
+            if self.vendors.find(record["vendorName"]):
+                vendor = self.vendors.find(record["vendorName"])
                 skip_vendor = False
             else:
                 skip_vendor = True
 
-        # NOTE: We can proceed even without a Vendor if we are updating an existing Bill
-        if skip_vendor == True and not updating_bill:
+        # NOTE: We can proceed even without a Vendor if we are updating an existing Bill,
+        # whether it exists is checked with the rest of the batch
+        if skip_vendor == True and not bill_id:
             raise Exception(f"A valid vendor is required for creating bill. No match found for {record.get('vendorName')}.")
 
         if vendor is not None:
@@ -553,22 +448,16 @@ class BillSink(QuickbooksSink):
             detail_type = "ItemBasedExpenseLineDetail"
 
             if row.get("taxCode"):
-                tax_code = self.search_reference_data(
-                    self.tax_codes, "Name", row.get("taxCode")
-                ).get("Id")
+                tax_code = (self.tax_codes.find(row.get("taxCode")) or {}).get("Id")
                 if tax_code:
                     line_detail["TaxCodeRef"] = {"value": tax_code}
 
             class_id = None
             if row.get("classId"):
-                class_id = self.search_reference_data(
-                    self.classes.values(), "Id", row.get("classId")
-                ).get("Id")
+                class_id = (self.classes.by_id(row.get("classId")) or {}).get("Id")
 
             elif row.get("className"):
-                class_id = self.search_reference_data(
-                    self.classes.values(), "Name", row.get("className")
-                ).get("Id")
+                class_id = (self.classes.find(row.get("className")) or {}).get("Id")
 
             if class_id:
                 line_detail["ClassRef"] = {
@@ -577,8 +466,8 @@ class BillSink(QuickbooksSink):
 
             # Check if product name is provided
             if row.get("productName"):
-                if row.get("productName") in self.items:
-                    product_ref = self.items[row.get("productName")].get("Id")
+                if self.items.find(row.get("productName")):
+                    product_ref = self.items.find(row.get("productName")).get("Id")
                     line_detail["ItemRef"] = {"value": product_ref}
                     line_detail["UnitPrice"] = row.get("unitPrice")
                     line_detail["Qty"] = row.get("quantity")
@@ -593,9 +482,7 @@ class BillSink(QuickbooksSink):
                 # acct_num = str(row["accountName"])
                 if row["accountName"] is not None:
                     acct_name = row["accountName"]
-                    acct_ref = self.accounts.get(
-                        acct_name, self.accounts.get(acct_name, {})
-                    ).get("Id")
+                    acct_ref = (self.accounts.find(acct_name) or {}).get("Id")
                 detail_type = "AccountBasedExpenseLineDetail"
                 line_detail["AccountRef"] = {"value": acct_ref}
                 line_detail["TaxAmount"] = row.get("taxAmount")
@@ -644,8 +531,16 @@ class BillSink(QuickbooksSink):
         if record.get("currency"):
             entry["CurrencyRef"] = {"value": record["currency"]}
 
-        if updating_bill:
+        if bill_id:
+            # Bills that don't exist yet are created, as long as they have a vendor
             entry = ["Bill", entry, "update"]
+            self.lookup_sync_token(
+                context,
+                "Bill",
+                entry,
+                create_missing=vendor is not None,
+                missing_error=f"A valid vendor is required for creating bill. No match found for {record.get('vendorName')}.",
+            )
         else:
             entry = ["Bill", entry, "create"]
 
@@ -654,6 +549,7 @@ class BillSink(QuickbooksSink):
 
 class DepositsSink(QuickbooksSink):
     name = "Deposits"
+    reference_collections = ("accounts", "accounts_name", "classes", "customers")
 
     def _process_deposit(self, deposit):
         deposit = deposit_from_unified(deposit, self)
@@ -671,6 +567,7 @@ class DepositsSink(QuickbooksSink):
 
 class BillPaymentsSink(QuickbooksSink):
     name = "BillPayments"
+    reference_collections = ("vendors", "accounts")
 
     def get_transaction(self, record, context):
         transaction_id = record.get("transactionId")
@@ -714,7 +611,7 @@ class BillPaymentsSink(QuickbooksSink):
         vendor_name = record.get("vendorName")
         transaction = None
         if vendor_id:
-            vendor = next((vendor for vendor in self.vendors.values() if vendor.get("Id", None) == vendor_id), None)
+            vendor = self.vendors.by_id(vendor_id)
             if not vendor:
                 entry = ["BillPayments", {
                     "error": f"Invalid vendorId={vendor_id}. Record={record}"
@@ -723,7 +620,7 @@ class BillPaymentsSink(QuickbooksSink):
                 return
             new_record["VendorRef"] = {"value": vendor["Id"]}
         elif vendor_name:
-            vendor = self.vendors.get(vendor_name)
+            vendor = self.vendors.find(vendor_name)
             if vendor is None:
                 entry = ["BillPayments", {
                     "error": f"Invalid vendorName={vendor_name}. Record={record}"
@@ -752,9 +649,9 @@ class BillPaymentsSink(QuickbooksSink):
         account_name = record.get("accountName")
         account = None
         if account_id:
-            account = next((account for account in self.accounts.values() if account.get("Id", None) == account_id), None)
+            account = self.accounts.by_id(account_id)
         if account_name and account is None:
-            account = self.accounts.get(account_name)
+            account = self.accounts.find(account_name)
         if account is None:
             entry = ["BillPayments", {
                 "error": f"accountId/accountName not found. Record={record}"
@@ -2,8 +2,22 @@
 
 from singer_sdk import typing as th
 from target_hotglue.target import TargetHotglue
+from target_hotglue.target_base import update_state
+from target_quickbooks.auth import TokenManager
 from target_quickbooks.util import cleanup
+from target_quickbooks.reference import ReferenceCache, ReferenceSnapshot
+from target_quickbooks.transport import Transport
 import atexit
+import copy
+import multiprocessing
+import os
+import queue
+import re
+import tempfile
+import threading
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 
 from target_quickbooks.sinks import (
     BillSink,
@@ -28,8 +42,12 @@ class TargetQuickBooks(TargetHotglue):
     """Sample target for QuickBooks."""
 
     name = "target-quickbooks"
-    target_counter = {}
     MAX_PARALLELISM = 1
+    MAX_CONCURRENT_QUERIES = 8
+    # Input lines read ahead while waiting on batches with batch_max_latency
+    INPUT_BUFFER_SIZE = 1000
+    # Start of a RECORD message as taps write it, used to split the input by stream without decoding it
+    RECORD_PREFIX = re.compile(r'\{\s*"type"\s*:\s*"RECORD"\s*,\s*"stream"\s*:\s*("(?:[^"\\]|\\.)*")')
     config_jsonschema = th.PropertiesList(
         th.Property("client_id", th.StringType, required=True),
         th.Property("client_secret", th.StringType, required=True),
@@ -38,6 +56,30 @@ class TargetQuickBooks(TargetHotglue):
         th.Property("redirect_uri", th.StringType, required=True),
         th.Property("realmId", th.StringType, required=True),
         th.Property("is_sanbox", th.BooleanType, required=False),
+        th.Property("page_size", th.IntegerType, required=False),
+        th.Property("query_concurrency", th.IntegerType, required=False),
+        th.Property("reference_concurrency", th.IntegerType, required=False),
+        th.Property("batch_queries", th.BooleanType, required=False),
+        th.Property("projection_queries", th.BooleanType, required=False),
+        th.Property("optimistic_updates", th.BooleanType, required=False),
+        th.Property("http_pool_size", th.IntegerType, required=False),
+        th.Property("http_connect_timeout", th.NumberType, required=False),
+        th.Property("http_read_timeout", th.NumberType, required=False),
+        th.Property("http_retries", th.IntegerType, required=False),
+        th.Property("batch_in_flight", th.IntegerType, required=False),
+        th.Property("entity_in_flight", th.IntegerType, required=False),
+        th.Property("adaptive_concurrency", th.BooleanType, required=False),
+        th.Property("pipeline_depth", th.IntegerType, required=False),
+        th.Property("max_parallelism", th.IntegerType, required=False),
+        th.Property("stream_processes", th.IntegerType, required=False),
+        th.Property("batch_max_latency", th.NumberType, required=False),
+        th.Property("realm_rate_limit", th.IntegerType, required=False),
+        th.Property("query_rate_limit", th.IntegerType, required=False),
+        th.Property("entity_rate_limit", th.IntegerType, required=False),
+        th.Property("batch_rate_limit", th.IntegerType, required=False),
+        th.Property("max_retries", th.IntegerType, required=False),
+        th.Property("retry_backoff", th.NumberType, required=False),
+        th.Property("reference_cache_dir", th.StringType, required=False),
     ).to_dict()
     SINK_TYPES = [
         BillSink,
@@ -55,41 +97,259 @@ class TargetQuickBooks(TargetHotglue):
         DepositsSink,
         BillPaymentsSink
     ]
+    # Streams are drained tier by tier, the streams of a tier only reference entities
+    # written by the tiers before it so they can drain in parallel
+    DRAIN_TIERS = [
+        (PaymentMethodSink, PaymentTermSink, TaxRateSink, DepartmentSink),
+        (CustomerSink, VendorSink, ItemSink),
+        (InvoiceSink, SalesReceiptSink, CreditNoteSink, BillSink, JournalEntrySink, DepositsSink),
+        (BillPaymentsSink,),
+    ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Number of streams drained at the same time
+        self.max_parallelism = int(self.config.get("max_parallelism", self.MAX_PARALLELISM))
+        # Keep-alive connections shared by all sinks
+        self.transport = Transport.from_config(self.config)
+        # OAuth tokens shared by all sinks, refreshed in the background and when QBO rejects them
+        self.tokens = TokenManager(self._config, self._config_file_path, self.transport)
+        self.transport.tokens = self.tokens
+        # Reference data shared by all sinks, each collection is fetched once per run
+        self.reference_cache = ReferenceCache()
+        # Optional on-disk copy of the reference data, refreshed incrementally between runs
+        self.reference_snapshot = None
+        if self.config.get("reference_cache_dir"):
+            self.reference_snapshot = ReferenceSnapshot(
+                Path(self.config["reference_cache_dir"]) / f"{self.config.get('realmId')}.json"
+            )
+        # Last SyncToken written for each (entity type, Id), used by optimistic updates
+        self.sync_tokens = {}
+        # QBO allows 10 concurrent requests per realm, queries stay below that
+        self.query_slots = threading.BoundedSemaphore(self.MAX_CONCURRENT_QUERIES)
+        # Set on the targets run by stream workers, their state goes to the coordinator, see _process_streams
+        self.stream_worker = False
+        self.worker_state = None
 
     def _process_lines(self, file_input):
         """
-        Custom _process_lines method that enables single sink processing,
-        adding a counter dictionary to the target.
+        Custom _process_lines method that streams the input to the sinks.
+
+        Batches are written once they're full, before the first record of a stream
+        in a later drain tier (see DRAIN_TIERS), on STATE messages and at the end of
+        the input. Switching between streams of the same tier doesn't write them, so
+        those are drained together. With batch_max_latency set,
+        batches waiting for more input are also written once their oldest record
+        is older than that many seconds.
+        """
+        if int(self.config.get("stream_processes", 0)) > 1:
+            return self._process_streams(file_input)
+
+        max_latency = self.config.get("batch_max_latency")
+        if max_latency:
+            file_input = self._timed_lines(file_input, float(max_latency))
 
-        This dictionary is accessed on the client.py, is_full() method, where
-        we get the _total_records_read and compare with the target_counter.
+        return super()._process_lines(file_input)
 
-        If we have the same number on both, we know that we have processed all
-        and we are good to send the request.
+    def _process_streams(self, file_input):
+        """Write each stream of the input from its own worker process.
+
+        The input is split into one spool file per stream, then the streams are
+        written tier by tier (see DRAIN_TIERS) by up to stream_processes workers.
+        Workers share the access token refreshed here, and their states are merged
+        into the state emitted at the end of the input.
         """
-        lines = []
-        for line in file_input:
-            lines.append(line)
-            line_dict = json.loads(line)
-            if line_dict.get("type") != "RECORD":
+        with tempfile.TemporaryDirectory(prefix="target-quickbooks-") as spool_dir:
+            spools, counter = self.split_streams(file_input, spool_dir)
+            self.logger.info(
+                f"Target '{self.name}' split {sum(counter.values())} lines of input "
+                f"({counter['RECORD']} records) into {len(spools)} streams."
+            )
+            if not spools:
+                return counter
+
+            # Workers start with the same token
+            self.tokens.ensure_valid()
+            tiers = {}
+            for sink_name, spool_path in spools.items():
+                tiers.setdefault(self.drain_tier(self.get_sink_class(sink_name)), []).append(spool_path)
+
+            processes = min(int(self.config["stream_processes"]), len(spools))
+            with self.stream_executor(processes) as executor:
+                for tier in sorted(tiers):
+                    # Workers read their config when they start, each tier gets the latest token
+                    worker_config = {**self.config, "stream_processes": 0}
+                    futures = [
+                        executor.submit(run_stream, worker_config, self._config_file_path, spool_path)
+                        for spool_path in tiers[tier]
+                    ]
+                    for future in futures:
+                        result = future.result()
+                        self._latest_state = update_state(self._latest_state, result["state"], self.logger)
+                        self.tokens.adopt(result["token"])
+
+        return counter
+
+    def stream_executor(self, processes):
+        # Workers are spawned, forking would copy the threads and connections of this process
+        return ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def split_streams(self, file_input, spool_dir):
+        """Spool the messages of each stream to its own file, returning the spool paths by stream and a message counter."""
+        spools = {}
+        files = {}
+        counter = Counter()
+
+        try:
+            for line in file_input:
+                if not line.strip():
+                    continue
+
+                # Records are only decoded by the workers
+                match = self.RECORD_PREFIX.match(line.lstrip())
+                if match:
+                    message_type, stream = "RECORD", json.loads(match.group(1))
+                else:
+                    message = json.loads(line)
+                    message_type, stream = message.get("type"), message.get("stream")
+                counter[message_type] += 1
+
+                if stream is None:
+                    if message_type == "STATE" and not self._latest_state:
+                        self._latest_state = message["value"]
+                    continue
+
+                sink_class = self.get_sink_class(stream)
+                sink_name = sink_class.name if sink_class else stream
+                if sink_name not in files:
+                    spools[sink_name] = os.path.join(spool_dir, f"{len(spools)}.jsonl")
+                    files[sink_name] = open(spools[sink_name], "w", encoding="utf-8")
+                files[sink_name].write(line if line.endswith("\n") else line + "\n")
+        finally:
+            for spool in files.values():
+                spool.close()
+
+        return spools, counter
+
+    def _timed_lines(self, file_input, max_latency):
+        """Yield the input lines, draining the sinks that waited too long for more input in between."""
+        lines = queue.Queue(maxsize=self.INPUT_BUFFER_SIZE)
+
+        def read():
+            try:
+                for line in file_input:
+                    lines.put(line)
+            except Exception as e:
+                # Raised again from the main thread
+                lines.put(e)
+            lines.put(None)
+
+        threading.Thread(target=read, name="input-reader", daemon=True).start()
+
+        while True:
+            # Wait at most until the oldest pending batch is due
+            ages = [sink.batch_age for sink in self.active_sinks.values() if sink.current_size]
+            timeout = max(0.0, max_latency - max(ages)) if ages else None
+            try:
+                line = lines.get(timeout=timeout)
+            except queue.Empty:
+                for sink in list(self.active_sinks.values()):
+                    if sink.current_size and sink.batch_age >= max_latency:
+                        self.logger.info(f"Target sink for '{sink.stream_name}' waited {max_latency}s for records. Draining...")
+                        self.drain_one(sink)
                 continue
-            self.target_counter[line_dict["stream"]] = self.target_counter.get(
-                line_dict["stream"], 0
-            ) + 1
 
-        super()._process_lines(lines)
-    
+            if line is None:
+                return
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+    def _process_state_message(self, message_dict: dict) -> None:
+        super()._process_state_message(message_dict)
+        # Records read before a STATE message are written when it arrives
+        if any(sink.current_size for sink in self.active_sinks.values()):
+            self.drain_all()
+
     def _process_record_message(self, message_dict: dict) -> None:
         if message_dict["stream"] not in self.mapper.stream_maps:
             sink = self.get_sink_class(message_dict["stream"])
             message_dict["stream"] = sink.name
-        return super()._process_record_message(message_dict)
+
+        # Records may reference entities of the streams in earlier tiers, those are written first
+        tier = self.drain_tier(self.get_sink_class(message_dict["stream"]))
+        dependencies = [
+            sink
+            for stream_name, sink in self.active_sinks.items()
+            if stream_name != message_dict["stream"]
+            and self.drain_tier(type(sink)) < tier
+            and (sink.current_size or (sink.pipeline and sink.pipeline.pending))
+        ]
+        if dependencies:
+            self._drain_all(dependencies, self.max_parallelism)
+
+        # The target's state only holds the input's state, the sinks' states are added
+        # when draining. TargetHotglue merges the sink's state into the target's one,
+        # in place, which would write its bookmarks twice, or fail to drain when the
+        # sink hasn't drained a batch yet. It's given a copy to merge into instead.
+        latest_state = self._latest_state
+        self._latest_state = copy.deepcopy(latest_state)
+        super()._process_record_message(message_dict)
+        self._latest_state = latest_state
+
+    def _drain_all(self, sink_list, parallelism: int) -> None:
+        tiers = {}
+        # Streams without a sink class have None sinks
+        for sink in filter(None, sink_list):
+            tiers.setdefault(self.drain_tier(type(sink)), []).append(sink)
+
+        for tier in sorted(tiers):
+            super()._drain_all(tiers[tier], parallelism)
+            # Draining completes once the batches written in the background are sent
+            for sink in tiers[tier]:
+                sink.flush_pipeline()
+
+    def _process_endofpipe(self) -> None:
+        super()._process_endofpipe()
+        self.tokens.stop()
+
+    def _write_state_message(self, state: dict) -> None:
+        # Stream workers hand their state to the coordinator, which emits the merged state
+        if self.stream_worker:
+            self.worker_state = state
+            return
+        super()._write_state_message(state)
+
+    @property
+    def active_sinks(self):
+        """Sinks of the streams seen so far, without the None sinks of streams that have no sink class."""
+        return {stream_name: sink for stream_name, sink in self._sinks_active.items() if sink is not None}
+
+    def drain_tier(self, sink_class):
+        """Position of `sink_class` in DRAIN_TIERS, unknown sinks are drained last."""
+        for tier, sink_classes in enumerate(self.DRAIN_TIERS):
+            if sink_class in sink_classes:
+                return tier
+        return len(self.DRAIN_TIERS)
 
     def get_sink_class(self, stream_name: str):
         for sink_class in self.SINK_TYPES:
             if sink_class.name.lower() == stream_name.lower():
                 return sink_class
 
+def run_stream(config, config_file_path, spool_path):
+    """Write the stream spooled at `spool_path`, returning its state and the latest token. Runs in the workers."""
+    target = TargetQuickBooks(config=config)
+    target._config_file_path = config_file_path
+    target.tokens.config_file_path = config_file_path
+    target.stream_worker = True
+
+    with open(spool_path, encoding="utf-8") as spool:
+        target.listen(spool)
+
+    return {"state": target.worker_state, "token": target.tokens.token}
+
+
 if __name__ == "__main__":
     atexit.register(cleanup)
     TargetQuickBooks.cli()
@@ -0,0 +1,102 @@
+import json
+import time
+from unittest.mock import MagicMock, patch
+from target_quickbooks.auth import TokenManager
+from target_quickbooks.sinks import InvoiceSink, ItemSink
+from target_quickbooks.transport import RateLimiter, Transport
+
+
+def fake_auth_client(tokens):
+    """AuthClient returning `access_1`, `access_2`... on each refresh."""
+    auth_client = MagicMock(access_token=None, refresh_token=None)
+
+    def refresh(refresh_token):
+        count = auth_client.refresh.call_count
+        auth_client.access_token = f"access_{count}"
+        auth_client.refresh_token = f"refresh_{count}"
+
+    auth_client.refresh.side_effect = refresh
+    tokens._auth_client = auth_client
+    return auth_client
+
+
+def test_sinks_share_one_token_and_refresh(mock_target):
+    auth_client = fake_auth_client(mock_target.tokens)
+
+    # The token of the config has no last_update, the first sink refreshes it
+    invoice_sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+    item_sink = ItemSink(target=mock_target, stream_name="Items", schema={"properties": {}}, key_properties=None)
+    # Both sinks see the token expire, only one of them refreshes it
+    mock_target._config["last_update"] -= TokenManager.LIFETIME
+    invoice_sink.start_batch({})
+    item_sink.start_batch({})
+    mock_target.tokens.stop()
+
+    assert auth_client.refresh.call_count == 2
+    assert invoice_sink.access_token == item_sink.access_token == "access_2"
+
+
+def test_token_is_refreshed_in_the_background_before_it_expires(mock_config):
+    tokens = TokenManager(mock_config)
+    auth_client = fake_auth_client(tokens)
+    # Due for a refresh in 50ms
+    mock_config["last_update"] = time.time() - TokenManager.LIFETIME + TokenManager.MARGIN + 0.05
+
+    tokens.start()
+    deadline = time.monotonic() + 5
+    while tokens.access_token != "access_1" and time.monotonic() < deadline:
+        time.sleep(0.01)
+    tokens.stop()
+
+    assert auth_client.refresh.call_count == 1
+    assert tokens.is_valid()
+
+
+def test_rejected_token_is_refreshed_once_and_the_call_retried(mock_config):
+    # Throttling budgets are covered by test_transport
+    transport = Transport(limiter=RateLimiter({"realm": 0, "batch": 0}))
+    transport.tokens = TokenManager(mock_config, transport=transport)
+    auth_client = fake_auth_client(transport.tokens)
+
+    def request(method, url, headers=None, **kwargs):
+        status = 200 if headers["Authorization"] == "Bearer access_1" else 401
+        return MagicMock(status_code=status, headers={})
+
+    headers = {"Authorization": "Bearer test_access_token"}
+    with patch.object(transport.session, "request", side_effect=request) as session_request:
+        responses = [transport.request("POST", "https://qbo/v3/company/1/batch", headers=headers) for _ in range(2)]
+    transport.tokens.stop()
+
+    assert [r.status_code for r in responses] == [200, 200]
+    auth_client.refresh.assert_called_once_with("test_refresh_token")
+    # The second call kept the rejected token, it's retried without refreshing again
+    assert session_request.call_count == 4
+    assert headers == {"Authorization": "Bearer test_access_token"}
+
+
+def test_processes_of_a_realm_adopt_the_token_another_one_refreshed(mock_config, tmp_path):
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps({**mock_config, "stream_processes": 2}))
+    # Two target processes started from the same config
+    first = TokenManager(dict(mock_config), str(config_file))
+    second = TokenManager(dict(mock_config), str(config_file))
+    first_client, second_client = fake_auth_client(first), fake_auth_client(second)
+
+    first.ensure_valid()
+    second.ensure_valid()
+
+    second_client.refresh.assert_not_called()
+    assert second.token == first.token
+    stored = json.loads(config_file.read_text())
+    assert {key: stored[key] for key in ("access_token", "refresh_token")} == {"access_token": "access_1", "refresh_token": "refresh_1"}
+    # Only the tokens are replaced, and no temporary file is left behind
+    assert stored["stream_processes"] == 2
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["config.json", "config.json.lock"]
+
+    # Once that token expired too, it's refreshed with the refresh token the other process got
+    stored["last_update"] -= TokenManager.LIFETIME
+    config_file.write_text(json.dumps(stored))
+    second._config["last_update"] = 1
+    second.ensure_valid()
+
+    second_client.refresh.assert_called_once_with("refresh_1")
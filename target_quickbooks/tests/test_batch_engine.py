@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from unittest.mock import PropertyMock, patch
+from target_quickbooks.client import QuickbooksSink
+from target_quickbooks.sinks import InvoiceSink
+from target_quickbooks.transport import RateLimiter
+
+
+class FakeBatchServer(ThreadingHTTPServer):
+    """Local QBO /batch endpoint that answers slowly, in reverse order, and tracks concurrent requests."""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeBatchHandler)
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.batches = []
+
+
+class FakeBatchHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+
+        items = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["BatchItemRequest"]
+        time.sleep(0.1)
+        body = json.dumps({
+            "BatchItemResponse": [
+                {"bId": item["bId"], "Invoice": {"Id": item["bId"][3:], "SyncToken": "0"}}
+                for item in reversed(items)
+            ]
+        }).encode()
+
+        with server.lock:
+            server.in_flight -= 1
+            server.batches.append(len(items))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def fake_server():
+    server = FakeBatchServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+
+@pytest.mark.parametrize("batch_in_flight", [1, 3])
+def test_batches_are_sent_concurrently_and_states_keep_record_order(mock_target, fake_server, batch_in_flight):
+    mock_target._config["batch_in_flight"] = batch_in_flight
+    # Throttling budgets are covered by test_transport
+    mock_target.transport.limiter = RateLimiter({"batch": 0})
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+
+    assert sink.batch_size == 30 * batch_in_flight
+
+    context = {"records": [["Invoice", {"DocNumber": str(i)}, "create"] for i in range(75)]}
+    base_url = f"http://127.0.0.1:{fake_server.server_port}/v3/company/1"
+    with patch.object(QuickbooksSink, "base_url", new_callable=PropertyMock, return_value=base_url):
+        sink.process_batch(context)
+
+    assert sorted(fake_server.batches) == [15, 30, 30]
+    assert fake_server.max_in_flight == batch_in_flight
+    states = sink.latest_state["bookmarks"]["Invoices"]
+    assert [state["Id"] for state in states] == [str(i) for i in range(75)]
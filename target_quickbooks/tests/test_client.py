@@ -0,0 +1,183 @@
+import re
+import threading
+import time
+import pytest
+from unittest.mock import MagicMock, patch
+from target_quickbooks.client import QuickbooksSink
+from target_quickbooks.sinks import CustomerSink, InvoiceSink, ItemSink, TaxRateSink
+
+
+@pytest.fixture
+def mock_item_sink(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        return ItemSink(target=mock_target, stream_name="Items", schema={"properties": {}}, key_properties=None)
+
+
+def fake_query(total):
+    def query(entity_type, query):
+        if query.startswith("select count(*)"):
+            return {"totalCount": total}
+        position, page_size = map(int, re.search(r"STARTPOSITION (\d+) MAXRESULTS (\d+)", query).groups())
+        ids = range(position, min(position + page_size, total + 1))
+        if not ids:
+            return {}
+        return {"maxResults": len(ids), entity_type: [{"Id": str(i), "Name": f"{entity_type} {i}"} for i in ids]}
+    return query
+
+
+@pytest.mark.parametrize("query_concurrency", [1, 4])
+def test_fetch_entities_pages_in_order(mock_item_sink, query_concurrency):
+    mock_item_sink._config.update({"page_size": 10, "query_concurrency": query_concurrency})
+
+    with patch.object(QuickbooksSink, "query", side_effect=fake_query(35)) as query:
+        records = mock_item_sink.fetch_entities("Item")
+
+    assert [r["Id"] for r in records] == [str(i) for i in range(1, 36)]
+    # 4 pages, plus the count query when pages are fetched concurrently
+    assert query.call_count == (5 if query_concurrency > 1 else 4)
+
+
+def test_fetch_entities_single_page_skips_count(mock_item_sink):
+    with patch.object(QuickbooksSink, "query", side_effect=fake_query(3)) as query:
+        records = mock_item_sink.fetch_entities("Item")
+
+    assert len(records) == 3
+    query.assert_called_once()
+
+
+def fake_batch_api(totals):
+    """Answer /batch Query operations, in reverse order like QBO may do."""
+    def request_api(http_method, endpoint=None, params={}, request_data=None, headers={}, verify=True, stream=None):
+        items = []
+        for item in request_data["BatchItemRequest"]:
+            entity_type = item["Query"].split(" from ")[1].split(" ")[0]
+            response = fake_query(totals[entity_type])(entity_type, item["Query"])
+            items.append({"bId": item["bId"], "QueryResponse": response})
+        return MagicMock(json=MagicMock(return_value={"BatchItemResponse": items[::-1]}))
+    return request_api
+
+
+def test_reference_data_loads_through_batch_queries(mock_target):
+    mock_target._config.update({"batch_queries": True, "page_size": 10})
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+
+    totals = {"Customer": 25, "Item": 3, "TaxCode": 0, "Term": 1}
+    with patch.object(QuickbooksSink, "request_api", side_effect=fake_batch_api(totals)) as request_api:
+        sink.get_reference_data()
+
+    # First pages and counts in one call, the two remaining Customer pages in another
+    assert request_api.call_count == 2
+    assert len(sink.customers) == 25
+    assert len(sink.items) == 3
+    assert len(sink.tax_codes) == 0
+
+
+def test_batch_updates_resolve_sync_tokens_with_one_query(mock_item_sink):
+    entries = [["Item", {"Id": str(i), "Name": f"Item {i}", "sparse": True}, "update"] for i in (1, 2, 3)]
+    context = {"records": list(entries)}
+    for entry in entries:
+        mock_item_sink.lookup_sync_token(context, "Item", entry)
+
+    existing = {"maxResults": 2, "Item": [{"Id": "1", "SyncToken": "4"}, {"Id": "3", "SyncToken": "0"}]}
+    with patch.object(QuickbooksSink, "query", return_value=existing) as query:
+        mock_item_sink.resolve_lookups(context)
+
+    query.assert_called_once()
+    assert query.call_args.args[1].startswith(
+        "select Id, SyncToken from Item where Id in ('1', '2', '3') and Active in (true, false)"
+    )
+    assert [(r[1]["Id"], r[1]["SyncToken"]) for r in (entries[0], entries[2])] == [("1", "4"), ("3", "0")]
+    # The missing item is reported as failed instead of being written
+    assert entries[1][1:] == [{"error": "Item 2 not found. Skipping...", "id": "2"}, "error"]
+
+
+def test_optimistic_updates_retry_only_stale_items(mock_item_sink):
+    mock_item_sink._config["optimistic_updates"] = True
+    mock_item_sink._target.sync_tokens.update({("Item", "1"): "3", ("Item", "2"): "7"})
+
+    entries = [["Item", {"Id": str(i), "Name": f"Item {i}", "sparse": True}, "update"] for i in (1, 2)]
+    context = {"records": list(entries)}
+    for entry in entries:
+        mock_item_sink.lookup_sync_token(context, "Item", entry)
+
+    stale = {"Fault": {"Error": [{"Message": "Stale Object Error", "code": "5010"}]}}
+    responses = [
+        [{"bId": "bid0", "Item": {"Id": "1", "SyncToken": "4"}}, {"bId": "bid1", **stale}],
+        [{"bId": "bid1", "Item": {"Id": "2", "SyncToken": "9"}}],
+    ]
+    existing = {"maxResults": 1, "Item": [{"Id": "2", "SyncToken": "8"}]}
+
+    with patch.object(QuickbooksSink, "make_batch_request", side_effect=responses) as make_batch_request:
+        with patch.object(QuickbooksSink, "query", return_value=existing) as query:
+            mock_item_sink.process_batch(context)
+
+    # No lookup before the write, one for the stale item only
+    query.assert_called_once()
+    assert "Id in ('2')" in query.call_args.args[1]
+    retried = make_batch_request.call_args_list[1].args[0]
+    assert [(r["bId"], r["Item"]["SyncToken"]) for r in retried] == [("bid1", "8")]
+    assert mock_item_sink._target.sync_tokens[("Item", "2")] == "9"
+    assert all(state["success"] for state in mock_item_sink.latest_state["bookmarks"]["Items"])
+
+
+def test_inactive_customers_are_created_then_deactivated_in_one_batch(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = CustomerSink(target=mock_target, stream_name="Customers", schema={"properties": {}}, key_properties=None)
+
+    def batch_response(batch_requests):
+        response = []
+        for item in batch_requests:
+            customer = item["Customer"]
+            if customer.get("DisplayName") == "Broken":
+                response.append({"bId": item["bId"], "Fault": {"Error": [{"code": "6240"}]}})
+            else:
+                synced = {"Id": item["bId"][3:], "SyncToken": str(int(customer.get("SyncToken", "-1")) + 1)}
+                response.append({"bId": item["bId"], "Customer": {**customer, **synced}})
+        return response
+
+    context = {"records": [
+        ["Customer", {"DisplayName": "Active"}, "create"],
+        ["Customer", {"DisplayName": "Inactive", "Active": False}, "create"],
+        ["Customer", {"DisplayName": "Broken"}, "create"],
+        ["Customer", {"DisplayName": "Also inactive", "Active": False}, "create"],
+    ]}
+    with patch.object(QuickbooksSink, "make_batch_request", side_effect=batch_response) as make_batch_request:
+        sink.write_batch(context)
+
+    # Every customer is created in one batch, then the inactive ones are deactivated in another
+    assert make_batch_request.call_count == 2
+    assert make_batch_request.call_args_list[1].args[0] == [
+        {"bId": "bid1", "operation": "update", "Customer": {"Id": "1", "SyncToken": "0", "Active": False, "sparse": True}},
+        {"bId": "bid3", "operation": "update", "Customer": {"Id": "3", "SyncToken": "0", "Active": False, "sparse": True}},
+    ]
+    states = sink.latest_state["bookmarks"]["Customers"]
+    # A failed customer doesn't roll back the others
+    assert [state["success"] for state in states] == [True, True, False, True]
+    assert [state.get("SyncToken") for state in states] == ["0", "1", None, "1"]
+
+
+def test_tax_rates_are_written_concurrently_in_order(mock_target):
+    mock_target._config["entity_in_flight"] = 3
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = TaxRateSink(target=mock_target, stream_name="TaxRate", schema={"properties": {}}, key_properties=None)
+
+    lock = threading.Lock()
+    in_flight = {"now": 0, "max": 0}
+
+    def make_request(url, data, stream=None):
+        with lock:
+            in_flight["now"] += 1
+            in_flight["max"] = max(in_flight["max"], in_flight["now"])
+        time.sleep(0.05)
+        with lock:
+            in_flight["now"] -= 1
+        return {"TaxCode": data["TaxCode"]}
+
+    context = {"records": [["TaxService", {"TaxCode": f"Tax {i}"}, "create"] for i in range(6)]}
+    with patch.object(QuickbooksSink, "make_request", side_effect=make_request):
+        sink.write_batch(context)
+
+    assert in_flight["max"] == 3
+    states = sink.latest_state["bookmarks"]["TaxRate"]
+    assert [state["entityData"]["TaxCode"] for state in states] == [f"Tax {i}" for i in range(6)]
@@ -1,8 +1,8 @@
 import pytest
 from io import StringIO
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 from target_quickbooks.client import QuickbooksSink
-from target_quickbooks.sinks import InvoiceSink
+from target_quickbooks.sinks import BillSink, InvoiceSink
 
 @pytest.mark.parametrize("mock_data_invoice", ["mock_data_invoice_lowercase", "mock_data_invoice_uppercase"])
 def test_target_process_lines_lowercase_invoice(mock_target, mock_data_invoice, request):
@@ -37,11 +37,12 @@ def test_process_record_update_invoice(mock_invoice_sink, mock_invoice_dict):
     # context need to exist before the process record, so it could be updated
     context = {}
 
-    invoice_details = {"1": {"SyncToken": "token"}}
+    invoice_details = [{"Id": "1", "SyncToken": "token"}]
 
-    # Call process_record
-    mock_invoice_sink.get_entities.return_value = invoice_details
+    # Call process_record, the SyncToken is looked up with the rest of the batch
+    mock_invoice_sink.fetch_entities = MagicMock(return_value=invoice_details)
     mock_invoice_sink.process_record(record, context)
+    mock_invoice_sink.resolve_lookups(context)
 
     # Check if the invoice was created correctly
     assert len(context["records"]) == 1
@@ -49,15 +50,35 @@ def test_process_record_update_invoice(mock_invoice_sink, mock_invoice_dict):
     assert context["records"][0][2] == "update"
     assert context["records"][0][1]["SyncToken"] == "token"
 
-def test_process_record_invoice_not_found(mock_invoice_sink, mock_invoice_dict, capsys):
+def test_process_record_invoice_not_found(mock_invoice_sink, mock_invoice_dict):
     record = mock_invoice_dict
     record["id"] = "2"
 
     context = {}
 
-    mock_invoice_sink.get_entities.return_value = {}
+    mock_invoice_sink.fetch_entities = MagicMock(return_value=[])
     mock_invoice_sink.process_record(record, context)
+    with patch.object(QuickbooksSink, "send_batches", return_value=[]) as send_batches:
+        mock_invoice_sink.write_batch(context)
 
-    captured = capsys.readouterr()
-    assert f"Invoice {record['id']} not found. Skipping..." in captured.out
-    assert len(context.get("records", [])) == 0
+    # The invoice isn't sent, it's reported as failed instead
+    send_batches.assert_called_once_with([], {})
+    mock_invoice_sink.logger.warning.assert_called_once_with("Invoice 2 not found. Skipping...")
+    assert mock_invoice_sink.latest_state["bookmarks"]["Invoices"] == [
+        {"success": False, "error": "Invoice 2 not found. Skipping...", "id": "2"}
+    ]
+
+def test_process_record_bill_without_vendor_not_found(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        with patch.object(QuickbooksSink, "get_reference_data"):
+            sink = BillSink(target=mock_target, stream_name="Bills", schema={"properties": {}}, key_properties=None)
+    sink.vendors = MagicMock(find=MagicMock(return_value=None))
+
+    context = {}
+
+    sink.fetch_entities = MagicMock(return_value=[])
+    sink.process_record({"id": "2", "vendorName": "Unknown vendor"}, context)
+
+    # Bills can only be created with a vendor
+    with pytest.raises(Exception, match="A valid vendor is required for creating bill. No match found for Unknown vendor."):
+        sink.resolve_lookups(context)
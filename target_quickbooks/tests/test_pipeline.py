@@ -0,0 +1,62 @@
+import threading
+import pytest
+from unittest.mock import patch
+from target_quickbooks.client import QuickbooksSink
+from target_quickbooks.pipeline import BatchPipeline
+from target_quickbooks.sinks import InvoiceSink
+
+
+def test_pipeline_runs_batches_in_order_and_applies_backpressure():
+    release = threading.Event()
+    written = []
+
+    def write(n):
+        release.wait()
+        written.append(n)
+
+    pipeline = BatchPipeline(depth=1)
+    pipeline.submit(lambda: write(1))
+    pipeline.submit(lambda: write(2))
+
+    # The queue is full while the first batch is in flight
+    blocked = threading.Thread(target=pipeline.submit, args=(lambda: write(3),))
+    blocked.start()
+    blocked.join(timeout=0.1)
+    assert blocked.is_alive()
+
+    release.set()
+    blocked.join()
+    pipeline.flush()
+    assert written == [1, 2, 3]
+    assert pipeline.pending == 0
+
+    pipeline.submit(lambda: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        pipeline.flush()
+    pipeline.close()
+
+
+def test_batches_are_written_while_the_next_one_is_mapped(mock_target):
+    mock_target._config["pipeline_depth"] = 2
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+
+    release = threading.Event()
+    written = []
+
+    def write_batch(context):
+        release.wait()
+        written.append(context["records"])
+
+    with patch.object(QuickbooksSink, "write_batch", side_effect=write_batch):
+        sink.process_batch({"records": [1]})
+        sink.process_batch({"records": [2]})
+        # process_batch returned before either batch was written
+        assert written == []
+
+        release.set()
+        mock_target._drain_all([sink], 1)
+        assert written == [[1], [2]]
+
+    sink.clean_up()
+    assert sink.pipeline is None
@@ -0,0 +1,231 @@
+import pytest
+from datetime import datetime, timedelta, timezone
+from unittest.mock import MagicMock, patch
+from target_quickbooks.client import QuickbooksSink
+from target_quickbooks.reference import (
+    REFERENCE_ENTITIES,
+    ReferenceCache,
+    ReferenceIndex,
+    ReferenceRecord,
+    build_indexes,
+)
+from target_quickbooks.sinks import CustomerSink, InvoiceSink, ItemSink, PaymentMethodSink
+from target_quickbooks.target import TargetQuickBooks
+
+
+def test_reference_cache_loads_each_collection_once():
+    cache = ReferenceCache()
+    loader = MagicMock(side_effect=lambda missing: {name: {"Design": {"Id": "1"}} for name in missing})
+
+    first = cache.get_many(["items"], loader)
+    second = cache.get_many(["items", "customers"], loader)
+
+    assert first["items"] is second["items"]
+    assert "items" in cache and "customers" in cache
+    # Only the collections that weren't loaded yet are requested
+    assert [call.args[0] for call in loader.call_args_list] == [["items"], ["customers"]]
+
+
+def test_build_indexes_builds_all_collections_in_one_pass():
+    records = [
+        {"Id": "1", "Name": "Design", "Type": "Service"},
+        {"Id": "2", "Name": "Hardware", "Type": "Category"},
+    ]
+
+    indexes = build_indexes(records, REFERENCE_ENTITIES["Item"])
+
+    assert set(indexes["items"]) == {"Design", "Hardware"}
+    assert set(indexes["categories"]) == {"Hardware"}
+
+
+def test_build_indexes_falls_back_to_name_and_shares_identical_collections():
+    records = [
+        {"Id": "1", "Name": "Checking", "AcctNum": "1000"},
+        {"Id": "2", "Name": "Savings"},
+    ]
+
+    accounts = build_indexes(records, REFERENCE_ENTITIES["Account"])
+    terms = build_indexes([{"Id": "3", "Name": "Net 30"}], REFERENCE_ENTITIES["Term"])
+
+    assert set(accounts["accounts"]) == {"1000", "Savings"}
+    assert set(accounts["accounts_name"]) == {"Checking", "Savings"}
+    assert terms["terms"] is terms["sales_terms"]
+
+
+def test_sinks_load_only_declared_reference_data_on_first_access(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        payment_sink = PaymentMethodSink(target=mock_target, stream_name="PaymentMethod", schema={"properties": {}}, key_properties=None)
+        invoice_sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+
+    with patch.object(QuickbooksSink, "fetch_entities", return_value=[]) as fetch_entities:
+        payment_sink.process_record({"Name": "Cash"}, {})
+        assert fetch_entities.call_count == 0
+
+        invoice_sink.customers
+        invoice_sink.items
+        fetched = sorted(c.args[0] for c in fetch_entities.call_args_list)
+
+    assert fetched == ["Customer", "Item", "TaxCode", "Term"]
+
+
+def test_reference_index_resolves_by_id_name_and_normalized_name():
+    index = ReferenceIndex(key="DisplayName")
+    index.add({"Id": "7", "DisplayName": "Acme  Corp", "SyncToken": "0"})
+
+    assert index["Acme  Corp"]["Id"] == "7"
+    assert index.by_id(7)["DisplayName"] == "Acme  Corp"
+    assert index.find(" acme corp ")["Id"] == "7"
+    assert index.lookup("SyncToken", "0")["Id"] == "7"
+
+    index.add({"Id": "7", "DisplayName": "Acme Inc", "SyncToken": "1"})
+
+    assert "Acme  Corp" not in index
+    assert index.find("acme corp") is None
+    assert index.by_id("7")["SyncToken"] == "1"
+    assert len(index) == 1
+
+
+def test_reference_data_errors_are_reported_per_entity_type(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        invoice_sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+
+    def fetch_entities(entity_type, **kwargs):
+        if entity_type == "TaxCode":
+            raise Exception("boom")
+        return [{"Id": "1", "Name": "Design", "DisplayName": "John Doe"}]
+
+    with patch.object(QuickbooksSink, "fetch_entities", side_effect=fetch_entities):
+        with pytest.raises(Exception, match="TaxCode"):
+            invoice_sink.get_reference_data()
+
+    # Collections that loaded are kept and cached for the retry
+    assert invoice_sink.items.find("design")["Id"] == "1"
+    assert "TaxCode" not in mock_target.reference_cache
+
+
+def test_reference_records_are_selected_and_stored_compactly(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = CustomerSink(target=mock_target, stream_name="Customers", schema={"properties": {}}, key_properties=None)
+    sink.reference_collections = ("customers",)
+
+    customer = {
+        "Id": "1",
+        "SyncToken": "2",
+        "DisplayName": "John Doe",
+        "BillAddr": {"Line1": "1 Main St"},
+        "MetaData": {"CreateTime": "2020-01-01"},
+    }
+    response = {"QueryResponse": {"maxResults": 1, "Customer": [customer]}}
+
+    with patch.object(QuickbooksSink, "request_api", return_value=MagicMock(json=MagicMock(return_value=response))) as request_api:
+        record = sink.customers["John Doe"]
+
+    assert request_api.call_args.kwargs["params"]["query"].startswith(
+        "select Id, SyncToken, DisplayName, FullyQualifiedName, Active from Customer where Active=true"
+    )
+    assert isinstance(record, ReferenceRecord)
+    assert record["SyncToken"] == "2"
+    assert record.get("BillAddr") is None
+    assert record.to_dict() == {"Id": "1", "SyncToken": "2", "DisplayName": "John Doe"}
+    with pytest.raises(KeyError):
+        record["Name"]
+
+
+def test_writes_are_written_through_to_the_reference_cache(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        customer_sink = CustomerSink(target=mock_target, stream_name="Customers", schema={"properties": {}}, key_properties=None)
+        item_sink = ItemSink(target=mock_target, stream_name="Items", schema={"properties": {}}, key_properties=None)
+        invoice_sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+
+    items = [{"Id": "5", "Name": "Hardware", "Type": "Category", "SyncToken": "0"}]
+    with patch.object(QuickbooksSink, "fetch_entities", side_effect=lambda e, **kwargs: items if e == "Item" else []):
+        invoice_sink.get_reference_data()
+
+    customer_sink.handle_response({"Customer": {"Id": "9", "DisplayName": "New Customer", "SyncToken": "0"}})
+    item_sink.handle_batch_response([
+        {"bId": "bid0", "Item": {"Id": "5", "Name": "Hardware", "Type": "Category", "SyncToken": "1", "Active": False}},
+        {"bId": "bid1", "Item": {"Id": "6", "Name": "Design", "Type": "Service", "SyncToken": "0"}},
+    ])
+
+    assert invoice_sink.customers.find("new customer")["Id"] == "9"
+    assert invoice_sink.items.by_id("5") is None
+    assert invoice_sink.items["Design"]["SyncToken"] == "0"
+    invoice_sink.get_reference_data("categories")
+    assert invoice_sink.categories.find("Hardware") is None
+
+
+class FakeQuickbooks:
+    """Local fake of the QBO /query and /cdc endpoints."""
+
+    def __init__(self, customers):
+        self.customers = customers
+        self.changes = []
+        self.endpoints = []
+
+    def request_api(self, http_method, endpoint=None, params={}, request_data=None, headers={}, verify=True, stream=None):
+        self.endpoints.append(endpoint)
+        if endpoint == "/cdc":
+            assert params["entities"] == "Customer"
+            body = {
+                "CDCResponse": [{"QueryResponse": [{"Customer": self.changes}]}],
+                "time": "2030-01-01T00:00:00+00:00",
+            }
+        elif "STARTPOSITION 1 " in params["query"]:
+            body = {"QueryResponse": {"maxResults": len(self.customers), "Customer": self.customers}}
+        else:
+            body = {"QueryResponse": {}}
+        return MagicMock(json=MagicMock(return_value=body))
+
+
+def test_reference_snapshot_is_refreshed_through_cdc(mock_config, tmp_path):
+    mock_config["reference_cache_dir"] = str(tmp_path)
+    fake = FakeQuickbooks([
+        {"Id": "1", "DisplayName": "John Doe", "SyncToken": "0"},
+        {"Id": "2", "DisplayName": "Jane Doe", "SyncToken": "0"},
+    ])
+
+    def customers():
+        target = TargetQuickBooks(mock_config)
+        with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+            sink = CustomerSink(target=target, stream_name="Customers", schema={"properties": {}}, key_properties=None)
+        sink.reference_collections = ("customers",)
+        with patch.object(QuickbooksSink, "request_api", side_effect=fake.request_api):
+            return sink.customers
+
+    assert len(customers()) == 2
+    assert fake.endpoints == ["/query"]
+    assert (tmp_path / f"{mock_config['realmId']}.json").exists()
+
+    fake.endpoints = []
+    fake.changes = [
+        {"Id": "1", "DisplayName": "John Doe", "SyncToken": "1", "Active": True},
+        {"Id": "2", "status": "Deleted"},
+        {"Id": "3", "DisplayName": "New Customer", "SyncToken": "0", "Active": True},
+    ]
+    restored = customers()
+
+    assert fake.endpoints == ["/cdc"]
+    assert restored.by_id("1")["SyncToken"] == "1"
+    assert restored.by_id("2") is None
+    assert restored.find("new customer")["Id"] == "3"
+
+
+def test_reference_snapshot_changes_are_fetched_since_the_earliest_snapshot(mock_config, tmp_path):
+    mock_config["reference_cache_dir"] = str(tmp_path)
+    target = TargetQuickBooks(mock_config)
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        sink = CustomerSink(target=target, stream_name="Customers", schema={"properties": {}}, key_properties=None)
+
+    # QBO's CDC times use the realm's offset, the first snapshot times are in UTC.
+    # The vendors were taken an hour earlier, though their time sorts last as a string.
+    now = datetime.now(timezone.utc)
+    customers_time = (now - timedelta(hours=1)).astimezone(timezone(timedelta(hours=-7))).isoformat()
+    vendors_time = (now - timedelta(hours=2)).isoformat()
+    target.reference_snapshot.update({"Customer": []}, customers_time)
+    target.reference_snapshot.update({"Vendor": []}, vendors_time)
+
+    response = MagicMock(json=MagicMock(return_value={"CDCResponse": [], "time": now.isoformat()}))
+    with patch.object(QuickbooksSink, "request_api", return_value=response) as request_api:
+        sink.restore_reference_snapshot(["Customer", "Vendor"])
+
+    assert request_api.call_args.kwargs["params"]["changedSince"] == vendors_time
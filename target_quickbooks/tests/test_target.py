@@ -0,0 +1,290 @@
+import json
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
+from datetime import datetime
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+from target_quickbooks.client import QuickbooksSink
+from target_quickbooks.target import TargetQuickBooks
+
+
+def message_lines(*messages):
+    return [json.dumps(message) + "\n" for message in messages]
+
+
+def schema(stream):
+    return {"type": "SCHEMA", "stream": stream, "schema": {"properties": {"id": {"type": "string"}}}, "key_properties": []}
+
+
+def record(stream, id):
+    return {"type": "RECORD", "stream": stream, "record": {"id": id}}
+
+
+def process_lines(target, file_input, write=None):
+    """Run the target over `file_input`, returning the events seen by the sinks in order."""
+    events = []
+
+    def process_record(sink, record, context):
+        events.append(("record", sink.stream_name, record["id"]))
+        context.setdefault("records", []).append(record["id"])
+
+    def process_batch(sink, context):
+        if write:
+            write(sink)
+        events.append(("batch", sink.stream_name, context["records"]))
+        if not sink.latest_state:
+            sink.init_state()
+        for id in context["records"]:
+            sink.update_state({"id": id, "success": True})
+
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(QuickbooksSink, "is_token_valid", return_value=True))
+        stack.enter_context(patch.object(QuickbooksSink, "process_batch", autospec=True, side_effect=process_batch))
+        # Every sink maps its own records
+        for sink_class in TargetQuickBooks.SINK_TYPES:
+            stack.enter_context(
+                patch.object(sink_class, "process_record", autospec=True, side_effect=process_record)
+            )
+        target._process_lines(file_input)
+        target._process_endofpipe()
+
+    return events
+
+
+def test_batches_are_drained_before_dependent_streams_on_state_and_end_of_input(mock_target):
+    lines = message_lines(
+        schema("Customers"),
+        schema("Invoices"),
+        record("Customers", "1"),
+        record("Customers", "2"),
+        record("Invoices", "3"),
+        {"type": "STATE", "value": {"bookmarks": {}}},
+        record("Invoices", "4"),
+    )
+
+    events = process_lines(mock_target, iter(lines))
+
+    assert [e for e in events if e[0] == "batch"] == [
+        ("batch", "Customers", ["1", "2"]),
+        ("batch", "Invoices", ["3"]),
+        ("batch", "Invoices", ["4"]),
+    ]
+    # Customers are written before the first invoice is mapped
+    assert events.index(("batch", "Customers", ["1", "2"])) < events.index(("record", "Invoices", "3"))
+
+
+def test_streams_without_a_sink_are_ignored(mock_target):
+    lines = message_lines(schema("Unsupported"), schema("Invoices"), record("Invoices", "1"))
+
+    events = process_lines(mock_target, iter(lines))
+
+    assert events == [("record", "Invoices", "1"), ("batch", "Invoices", ["1"])]
+
+
+def test_streams_without_a_sink_are_ignored_on_state_and_after_max_latency(mock_target):
+    mock_target._config["batch_max_latency"] = 0.05
+    lines = message_lines(
+        schema("Unsupported"),
+        schema("Invoices"),
+        schema("BillPayments"),
+        record("Invoices", "1"),
+        {"type": "STATE", "value": {"bookmarks": {}}},
+        record("Invoices", "2"),
+        record("BillPayments", "3"),
+    )
+
+    def slow_input():
+        yield from lines[:6]
+        time.sleep(0.3)
+        yield lines[6]
+
+    events = process_lines(mock_target, slow_input())
+
+    assert events == [
+        ("record", "Invoices", "1"),
+        ("batch", "Invoices", ["1"]),
+        ("record", "Invoices", "2"),
+        ("batch", "Invoices", ["2"]),
+        ("record", "BillPayments", "3"),
+        ("batch", "BillPayments", ["3"]),
+    ]
+
+
+def test_streams_of_a_tier_keep_their_batches_when_the_input_switches(mock_target):
+    lines = message_lines(
+        schema("Customers"),
+        schema("Vendors"),
+        record("Customers", "1"),
+        record("Vendors", "2"),
+        record("Customers", "3"),
+        record("Vendors", "4"),
+    )
+
+    events = process_lines(mock_target, iter(lines))
+
+    # Vendors don't reference customers, both are only written at the end of the input
+    assert events[:4] == [
+        ("record", "Customers", "1"),
+        ("record", "Vendors", "2"),
+        ("record", "Customers", "3"),
+        ("record", "Vendors", "4"),
+    ]
+    assert sorted(events[4:]) == [
+        ("batch", "Customers", ["1", "3"]),
+        ("batch", "Vendors", ["2", "4"]),
+    ]
+
+
+def test_batches_waiting_for_input_are_drained_after_max_latency(mock_target):
+    mock_target._config["batch_max_latency"] = 0.05
+    lines = message_lines(schema("Invoices"), record("Invoices", "1"), record("Invoices", "2"))
+
+    def slow_input():
+        yield from lines[:2]
+        time.sleep(0.3)
+        yield lines[2]
+
+    events = process_lines(mock_target, slow_input())
+
+    assert events == [
+        ("record", "Invoices", "1"),
+        ("batch", "Invoices", ["1"]),
+        ("record", "Invoices", "2"),
+        ("batch", "Invoices", ["2"]),
+    ]
+
+
+def test_independent_streams_drain_in_parallel_before_their_dependents(mock_target):
+    mock_target.max_parallelism = 2
+    lines = message_lines(
+        schema("Customers"),
+        schema("Vendors"),
+        schema("Invoices"),
+        record("Customers", "1"),
+        record("Vendors", "2"),
+        record("Invoices", "3"),
+    )
+    # Customers and Vendors have to be written at the same time to get through the barrier
+    both_writing = threading.Barrier(2, timeout=5)
+
+    def write(sink):
+        if sink.stream_name != "Invoices":
+            both_writing.wait()
+
+    events = process_lines(mock_target, iter(lines), write)
+
+    assert events[:2] == [("record", "Customers", "1"), ("record", "Vendors", "2")]
+    assert sorted(events[2:4]) == [("batch", "Customers", ["1"]), ("batch", "Vendors", ["2"])]
+    assert events[4:] == [("record", "Invoices", "3"), ("batch", "Invoices", ["3"])]
+
+
+def test_streams_are_written_by_workers_and_their_states_merged(mock_target, capsys):
+    mock_target._config.update({"stream_processes": 2, "last_update": round(datetime.now().timestamp())})
+    lines = message_lines(
+        schema("Invoices"),
+        schema("customers"),
+        record("Invoices", "1"),
+        {"type": "STATE", "value": {"bookmarks": {}}},
+        record("customers", "2"),
+        record("Invoices", "3"),
+    )
+
+    # Workers run on threads so the sinks' patches apply to them
+    with patch.object(type(mock_target), "stream_executor", lambda self, processes: ThreadPoolExecutor(processes)):
+        events = process_lines(mock_target, iter(lines))
+
+    # Customers are written by a worker that finished before the invoices started
+    assert events == [
+        ("record", "customers", "2"),
+        ("batch", "customers", ["2"]),
+        ("record", "Invoices", "1"),
+        ("record", "Invoices", "3"),
+        ("batch", "Invoices", ["1", "3"]),
+    ]
+    state = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert state["bookmarks"] == {
+        "Customers": [{"id": "2", "success": True}],
+        "Invoices": [{"id": "1", "success": True}, {"id": "3", "success": True}],
+    }
+    assert state["summary"]["Invoices"]["success"] == 2
+
+
+class FakeQuickbooksHandler(BaseHTTPRequestHandler):
+    """Local QBO returning no reference data and creating every entity of a batch."""
+
+    def do_GET(self):
+        self.respond({"QueryResponse": {}})
+
+    def do_POST(self):
+        items = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["BatchItemRequest"]
+        responses = []
+        for i, item in enumerate(items):
+            entity = next(key for key in item if key not in ("bId", "operation"))
+            responses.append({"bId": item["bId"], entity: {**item[entity], "Id": str(i + 1), "SyncToken": "0"}})
+        self.respond({"BatchItemResponse": responses})
+
+    def respond(self, response):
+        body = json.dumps(response).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def use_quickbooks_at(base_url):
+    """Initializer of the spawned workers, sending their QBO requests to `base_url`."""
+    QuickbooksSink.base_url = property(lambda sink: base_url)
+
+
+def test_streams_are_written_by_spawned_workers(mock_target, capsys):
+    mock_target._config.update({"stream_processes": 2, "last_update": round(datetime.now().timestamp())})
+    lines = message_lines(
+        {"type": "SCHEMA", "stream": "Vendors", "schema": {"properties": {"vendorName": {"type": "string"}}}, "key_properties": []},
+        {"type": "RECORD", "stream": "Vendors", "record": {"vendorName": "Acme"}},
+        {"type": "RECORD", "stream": "Vendors", "record": {"vendorName": "Globex"}},
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeQuickbooksHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v3/company/1"
+
+    # The workers are real spawned processes, only their QBO host is replaced
+    executor = partial(ProcessPoolExecutor, initializer=use_quickbooks_at, initargs=(base_url,))
+    try:
+        with patch("target_quickbooks.target.ProcessPoolExecutor", executor):
+            mock_target._process_lines(iter(lines))
+            mock_target._process_endofpipe()
+    finally:
+        server.shutdown()
+
+    state = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert [(s["Id"], s["entityData"]["DisplayName"]) for s in state["bookmarks"]["Vendors"]] == [
+        ("1", "Acme"),
+        ("2", "Globex"),
+    ]
+    assert state["summary"]["Vendors"]["success"] == 2
+
+
+def test_bookmarks_are_emitted_once_after_an_input_state(mock_target, capsys):
+    lines = message_lines(
+        {"type": "STATE", "value": {"bookmarks": {}, "summary": {}}},
+        schema("Invoices"),
+        record("Invoices", "1"),
+        record("Invoices", "2"),
+        record("Invoices", "3"),
+    )
+
+    # One record per batch, each one drains the sink
+    with patch.object(QuickbooksSink, "max_size", 1):
+        process_lines(mock_target, iter(lines))
+
+    state = json.loads(capsys.readouterr().out.strip().splitlines()[-1])
+    assert state["bookmarks"] == {
+        "Invoices": [{"id": id, "success": True} for id in ("1", "2", "3")],
+    }
@@ -0,0 +1,199 @@
+import pytest
+import requests
+from unittest.mock import MagicMock, patch
+from target_quickbooks.client import QuickbooksSink
+from target_quickbooks.sinks import InvoiceSink, ItemSink
+from target_quickbooks.transport import AdaptiveConcurrency, RateLimiter, TokenBucket, Transport
+
+
+def test_transport_is_configurable(mock_config):
+    mock_config.update({"http_pool_size": 4, "http_read_timeout": 30, "http_retries": 1})
+
+    transport = Transport.from_config(mock_config)
+
+    assert transport.adapter._pool_maxsize == 4
+    assert transport.adapter.max_retries.connect == 1
+    assert transport.timeout == (10.0, 30.0)
+
+
+def test_sinks_share_the_target_connection_pool(mock_target):
+    with patch.object(QuickbooksSink, "is_token_valid", return_value=True):
+        invoice_sink = InvoiceSink(target=mock_target, stream_name="Invoices", schema={"properties": {}}, key_properties=None)
+        item_sink = ItemSink(target=mock_target, stream_name="Items", schema={"properties": {}}, key_properties=None)
+
+    transport = mock_target.transport
+    # Token refreshes go through the same pool
+    discovery_doc = {
+        key: f"https://oauth.platform.intuit.com/{key}"
+        for key in ("authorization_endpoint", "token_endpoint", "revocation_endpoint", "issuer", "jwks_uri", "userinfo_endpoint")
+    }
+    with patch("intuitlib.client.get_discovery_doc", return_value=discovery_doc):
+        auth_client = invoice_sink.auth_client
+    assert auth_client is item_sink.auth_client
+    assert auth_client.get_adapter(discovery_doc["token_endpoint"]) is transport.adapter
+
+    response = MagicMock(status_code=200, json=MagicMock(return_value={}))
+    with patch.object(transport.session, "request", return_value=response) as request:
+        invoice_sink.request_api("POST", endpoint="/batch", request_data={"BatchItemRequest": []})
+        item_sink.make_request(f"{item_sink.base_url}/item", {"Name": "Design"})
+
+    assert request.call_count == 2
+    assert all(call.kwargs["timeout"] == transport.timeout for call in request.call_args_list)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def test_token_bucket_paces_calls_at_its_rate():
+    clock = FakeClock()
+    bucket = TokenBucket(60, capacity=1, clock=clock, sleep=clock.sleep)
+
+    for _ in range(5):
+        bucket.acquire()
+
+    # One call per second after the initial token
+    assert clock.now == pytest.approx(4)
+
+
+def test_token_bucket_backs_off_on_throttling_and_recovers():
+    clock = FakeClock()
+    bucket = TokenBucket(60, capacity=1, clock=clock, sleep=clock.sleep)
+    bucket.acquire()
+
+    bucket.throttled(retry_after=10)
+    bucket.acquire()
+
+    assert clock.now == pytest.approx(10)
+    assert bucket.rate == pytest.approx(0.5)
+
+    for _ in range(20):
+        bucket.succeeded()
+    assert bucket.rate == pytest.approx(1)
+
+
+def test_rate_limiter_budgets_calls_by_kind(mock_config):
+    mock_config.update({"batch_rate_limit": 30, "realm_rate_limit": 0})
+    limiter = RateLimiter.from_config(mock_config)
+
+    assert limiter.kind("https://quickbooks.api.intuit.com/v3/company/1/query?query=x") == "query"
+    assert limiter.kind("https://quickbooks.api.intuit.com/v3/company/1/batch") == "batch"
+    assert limiter.kind("https://quickbooks.api.intuit.com/v3/company/1/customer") == "entity"
+    assert "realm" not in limiter.buckets
+    assert limiter.buckets["batch"].limit == 0.5
+
+    limiter.update("batch", MagicMock(status_code=429, headers={"Retry-After": "30"}))
+    assert limiter.buckets["batch"].rate == 0.25
+    assert limiter.buckets["query"].rate == limiter.buckets["query"].limit
+
+    # Only calls that aren't retried recover the rate
+    limiter.update("batch", MagicMock(status_code=503, headers={}))
+    assert limiter.buckets["batch"].rate == 0.25
+    limiter.update("batch", MagicMock(status_code=400, headers={}))
+    assert limiter.buckets["batch"].rate > 0.25
+
+
+def test_transport_retries_retryable_failures_with_backoff():
+    sleeps = []
+    transport = Transport(limiter=RateLimiter({kind: 0 for kind in RateLimiter.DEFAULT_LIMITS}), sleep=sleeps.append)
+    responses = [
+        MagicMock(status_code=503, headers={}),
+        requests.exceptions.ConnectionError("reset"),
+        MagicMock(status_code=200, headers={}),
+    ]
+
+    with patch.object(transport.session, "request", side_effect=responses) as request:
+        response = transport.request("POST", "https://quickbooks.api.intuit.com/v3/company/1/batch", params={"requestid": "x"})
+
+    assert response.status_code == 200
+    assert request.call_count == 3
+    assert len(sleeps) == 2 and sleeps[1] <= 2 * transport.backoff
+    # Every attempt is the same call, so QBO can deduplicate it
+    assert all(call.kwargs["params"] == {"requestid": "x"} for call in request.call_args_list)
+
+
+def test_retried_writes_reuse_their_requestid(mock_invoice_sink):
+    transport = mock_invoice_sink._target.transport
+    transport.limiter = RateLimiter({kind: 0 for kind in RateLimiter.DEFAULT_LIMITS})
+    transport._sleep = lambda seconds: None
+    batch = [{"bId": "bid0", "operation": "create", "Invoice": {"DocNumber": "1"}}]
+    responses = [
+        MagicMock(status_code=503, headers={}),
+        MagicMock(status_code=200, headers={}, json=MagicMock(return_value={"BatchItemResponse": []})),
+        MagicMock(status_code=200, headers={}, json=MagicMock(return_value={"BatchItemResponse": []})),
+    ]
+
+    with patch.object(transport.session, "request", side_effect=responses) as request:
+        # The same content written twice, the first write is retried once
+        mock_invoice_sink.make_batch_request(batch)
+        mock_invoice_sink.make_batch_request(batch)
+
+    request_ids = [call.kwargs["params"]["requestid"] for call in request.call_args_list]
+    assert request_ids[0] == request_ids[1] != request_ids[2]
+
+
+def test_adaptive_concurrency_probes_up_and_backs_off():
+    clock = FakeClock()
+    controller = AdaptiveConcurrency(8, clock=clock)
+
+    # Flat latency grows the limit about one per round of calls
+    for _ in range(40):
+        clock.now += 1
+        controller.record(1.0, 200)
+    assert controller.limit == 8
+
+    clock.now += 1
+    controller.record(1.0, 429)
+    assert controller.limit == 4
+
+    # A call that started before the decrease doesn't back off again
+    controller.record(5.0, 503)
+    assert controller.limit == 4
+
+    clock.now += 10
+    controller.record(1.0, 200)
+    controller.record(3.0, 200)
+    assert controller.limit == pytest.approx(2.125)
+
+    # Every retryable status backs off, not only throttling
+    clock.now += 10
+    controller.record(1.0, 500)
+    assert controller.limit == pytest.approx(1.0625)
+
+
+def test_only_writes_feed_the_in_flight_limit_of_their_kind():
+    transport = Transport(limiter=RateLimiter({kind: 0 for kind in RateLimiter.DEFAULT_LIMITS}), sleep=lambda seconds: None, adaptive=True)
+    transport.in_flight_limit("batch", 8)
+    controller = transport.concurrency["batch"]
+    controller.limit = 8
+    url = "https://quickbooks.api.intuit.com/v3/company/1/batch"
+    responses = [MagicMock(status_code=status, headers={}) for status in (502, 200, 500, 200)]
+
+    with patch.object(transport.session, "request", side_effect=responses):
+        # Query operations go to /batch too, their failures don't limit the writes
+        transport.request("POST", url, json={"BatchItemRequest": [{"bId": "query0", "Query": "select * from Item"}]})
+        assert controller.limit == 8
+        transport.request("POST", url, params={"requestid": "x"})
+
+    # Halved by the write's 500, then its retry succeeded
+    assert controller.limit == pytest.approx(4.25)
+
+
+def test_adaptive_concurrency_is_reported_as_a_metric(mock_invoice_sink, mock_config):
+    transport = Transport.from_config({**mock_config, "adaptive_concurrency": True})
+
+    assert transport.in_flight_limit("batch", 4) == 1
+    transport.concurrency["batch"].limit = 3.5
+    mock_invoice_sink._target.transport = transport
+    mock_invoice_sink.write_concurrency_metric("batch", 4)
+
+    message = mock_invoice_sink.logger.info.call_args.args[0]
+    assert message.startswith("INFO METRIC: ")
+    assert '"metric": "concurrency", "value": 3' in message
@@ -0,0 +1,350 @@
+"""
+HTTP transport shared by every sink of a run
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Throttled and failed calls, retried by the transport and backed off from
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TokenBucket:
+    """Paces calls to `rate` per minute, allowing bursts of up to `capacity` calls.
+
+    A 429 halves the rate and pauses the bucket for its Retry-After, successes then
+    bring the rate back up to its limit gradually.
+    """
+
+    RECOVERY = 0.05  # Share of the limit recovered per successful call
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.limit = rate / 60
+        self.rate = self.limit
+        # Bursts are capped at 3 seconds worth of calls
+        self.capacity = capacity or max(1.0, 3 * self.limit)
+        self.tokens = self.capacity
+        self.paused_until = 0.0
+        self._clock = clock
+        self._sleep = sleep
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = self._clock()
+                self._refill(now)
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    wait = (1 - self.tokens) / self.rate
+            self._sleep(wait)
+
+    def throttled(self, retry_after=None):
+        with self._lock:
+            now = self._clock()
+            self.rate = max(self.limit / 10, self.rate / 2)
+            self.tokens = 0.0
+            self._updated = now
+            self.paused_until = max(self.paused_until, now + (retry_after or 1 / self.rate))
+
+    def succeeded(self):
+        if self.rate < self.limit:
+            with self._lock:
+                self.rate = min(self.limit, self.rate + self.limit * self.RECOVERY)
+
+
+class RateLimiter:
+    """QBO throttling budgets of a realm, per kind of call and for the realm as a whole."""
+
+    # Calls per minute, QBO allows 500 requests and 40 batch requests per minute per realm
+    DEFAULT_LIMITS = {"realm": 500, "query": 500, "entity": 500, "batch": 40}
+
+    def __init__(self, limits=None):
+        limits = {**self.DEFAULT_LIMITS, **(limits or {})}
+        # A limit of 0 disables that budget
+        self.buckets = {kind: TokenBucket(rate) for kind, rate in limits.items() if rate}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls({
+            kind: int(config[f"{kind}_rate_limit"])
+            for kind in cls.DEFAULT_LIMITS
+            if config.get(f"{kind}_rate_limit") is not None
+        })
+
+    @staticmethod
+    def kind(url):
+        path = url.split("?")[0]
+        if path.endswith("/batch"):
+            return "batch"
+        if path.endswith("/query") or path.endswith("/cdc"):
+            return "query"
+        return "entity"
+
+    def _buckets(self, kind):
+        return [self.buckets[k] for k in ("realm", kind) if k in self.buckets]
+
+    def acquire(self, kind):
+        for bucket in self._buckets(kind):
+            bucket.acquire()
+
+    def update(self, kind, response):
+        """Adjust the budgets of `kind` to the response QBO sent."""
+        if response.status_code == 429:
+            retry_after = response.headers.get("Retry-After")
+            try:
+                retry_after = float(retry_after) if retry_after else None
+            except ValueError:
+                retry_after = None
+            for bucket in self._buckets(kind):
+                bucket.throttled(retry_after)
+        elif response.status_code not in RETRY_STATUSES:
+            # Failures about to be retried don't bring the rate back up
+            for bucket in self._buckets(kind):
+                bucket.succeeded()
+
+
+class AdaptiveConcurrency:
+    """Additive-increase/multiplicative-decrease limit on the number of calls in flight.
+
+    The limit grows by about one per round of calls while the p95 latency stays close to
+    the best one observed, and is halved on retryable statuses, errors and latency spikes.
+    """
+
+    WINDOW = 20  # Latencies the p95 is computed over
+    TOLERANCE = 1.2  # p95 increase still considered flat
+    SPIKE = 2.0  # Latency over the baseline p95 considered a spike
+    BACKOFF_STATUSES = RETRY_STATUSES
+
+    def __init__(self, maximum, minimum=1, clock=time.monotonic):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(minimum)
+        self.baseline = None
+        self.latencies = deque(maxlen=self.WINDOW)
+        self._clock = clock
+        self._decreased_at = float("-inf")
+        self._lock = threading.Lock()
+
+    @property
+    def p95(self):
+        latencies = sorted(self.latencies)
+        return latencies[int(0.95 * (len(latencies) - 1))] if latencies else None
+
+    def record(self, latency, status=None, error=False):
+        """Adjust the limit to a call that took `latency` seconds."""
+        with self._lock:
+            started = self._clock() - latency
+
+            if error or status in self.BACKOFF_STATUSES:
+                self._decrease(started)
+                return
+
+            self.latencies.append(latency)
+            p95 = self.p95
+            # The baseline follows the lowest p95, drifting up slowly as the realm's load changes
+            if self.baseline is None or p95 < self.baseline:
+                self.baseline = p95
+            else:
+                self.baseline += (p95 - self.baseline) * 0.05
+
+            if latency > self.baseline * self.SPIKE:
+                self._decrease(started)
+            elif p95 <= self.baseline * self.TOLERANCE:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+    def _decrease(self, started):
+        # Calls that were already in flight at the last decrease don't count twice
+        if started < self._decreased_at:
+            return
+        self.limit = max(self.minimum, self.limit / 2)
+        self.latencies.clear()
+        self._decreased_at = self._clock()
+
+
+class Transport:
+    """Pooled keep-alive session used for all QBO traffic, including token refreshes.
+
+    Connections are reused across requests and sinks, so the TCP and TLS handshakes
+    are only paid once per pooled connection. Throttled, failed and timed out calls
+    are retried with exponential backoff, writes carry a requestid so QBO ignores
+    the duplicates. Calls QBO rejects with a 401 are retried once with a new token.
+    """
+
+    RETRY_STATUSES = RETRY_STATUSES
+
+    def __init__(
+        self,
+        pool_size=10,
+        connect_timeout=10,
+        read_timeout=300,
+        retries=3,
+        limiter=None,
+        max_retries=5,
+        backoff=1.0,
+        max_backoff=60.0,
+        sleep=time.sleep,
+        adaptive=False,
+    ):
+        # Only connection errors are retried here, the request never reached QBO so
+        # it can't be duplicated
+        self.adapter = HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=0,
+                backoff_factor=0.5,
+                raise_on_status=False,
+            ),
+        )
+        self.timeout = (connect_timeout, read_timeout)
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._sleep = sleep
+        # In-flight limits of the write calls, tuned from their latency when adaptive
+        self.adaptive = adaptive
+        self.concurrency = {}
+        self._concurrency_lock = threading.Lock()
+        # TokenManager of the target, used to replace tokens QBO rejects
+        self.tokens = None
+
+        self.session = requests.Session()
+        self.mount(self.session)
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            pool_size=int(config.get("http_pool_size", 10)),
+            connect_timeout=float(config.get("http_connect_timeout", 10)),
+            read_timeout=float(config.get("http_read_timeout", 300)),
+            retries=int(config.get("http_retries", 3)),
+            limiter=RateLimiter.from_config(config),
+            max_retries=int(config.get("max_retries", 5)),
+            backoff=float(config.get("retry_backoff", 1.0)),
+            adaptive=bool(config.get("adaptive_concurrency", False)),
+        )
+
+    def mount(self, session):
+        """Route the requests of another session (e.g. the OAuth client) through the pool."""
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+
+    def backoff_delay(self, attempt):
+        # Exponential backoff with full jitter so concurrent callers don't retry in lockstep
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        """Send a request, retrying retryable failures. The last response is returned as is."""
+        response = self._send(method, url, **kwargs)
+
+        authorization = (kwargs.get("headers") or {}).get("Authorization")
+        if response.status_code == 401 and self.tokens is not None and authorization:
+            # Every caller rejected with the same token waits on one refresh, then retries
+            logging.warning(f"Retrying {method} {url} with a new access token after HTTP 401")
+            self.tokens.refresh(authorization.split(" ", 1)[-1])
+            kwargs["headers"] = {**kwargs["headers"], "Authorization": f"Bearer {self.tokens.access_token}"}
+            response = self._send(method, url, **kwargs)
+
+        return response
+
+    def _send(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        kind = self.limiter.kind(url)
+
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+
+            # Wait for the throttling budget of the call, and adapt it to QBO's answer
+            self.limiter.acquire(kind)
+            controller = self.concurrency.get(kind) if self.is_write(kwargs) else None
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                if controller:
+                    controller.record(time.monotonic() - start, error=True)
+                if last_attempt:
+                    raise
+                logging.warning(f"Retrying {method} {url} after {type(e).__name__}: {e}")
+            else:
+                if controller:
+                    controller.record(time.monotonic() - start, response.status_code)
+                self.limiter.update(kind, response)
+                if last_attempt or response.status_code not in self.RETRY_STATUSES:
+                    return response
+                logging.warning(f"Retrying {method} {url} after HTTP {response.status_code}")
+
+            self._sleep(self.backoff_delay(attempt))
+
+    @staticmethod
+    def is_write(kwargs):
+        """Whether the call is a write, only writes feed the in-flight limits of their kind."""
+        # Writes carry a requestid, reads (including Query operations sent to /batch) don't
+        return "requestid" in (kwargs.get("params") or {})
+
+    def in_flight_limit(self, kind, in_flight):
+        """Current number of `kind` calls allowed in flight, out of at most `in_flight`."""
+        if not self.adaptive or in_flight <= 1:
+            return in_flight
+
+        with self._concurrency_lock:
+            controller = self.concurrency.get(kind)
+            if controller is None or controller.maximum != in_flight:
+                controller = self.concurrency[kind] = AdaptiveConcurrency(in_flight)
+        return max(1, int(controller.limit))
+
+    def gather(self, calls, in_flight=1, kind="batch"):
+        """Run the blocking `calls` with at most `in_flight` running at once, returning their results in order.
+
+        More than one call in flight runs them from an asyncio event loop, each one in the pool's worker threads.
+        With adaptive concurrency the limit is tuned between 1 and `in_flight` as the calls complete.
+        """
+        if in_flight <= 1 or len(calls) <= 1:
+            return [call() for call in calls]
+
+        async def run_all():
+            loop = asyncio.get_running_loop()
+            ready = asyncio.Condition()
+            running = 0
+
+            with ThreadPoolExecutor(max_workers=in_flight) as executor:
+                async def run(call):
+                    nonlocal running
+                    async with ready:
+                        await ready.wait_for(lambda: running < self.in_flight_limit(kind, in_flight))
+                        running += 1
+                    try:
+                        return await loop.run_in_executor(executor, call)
+                    finally:
+                        async with ready:
+                            running -= 1
+                            ready.notify_all()
+
+                return await asyncio.gather(*(run(call) for call in calls))
+
+        return asyncio.run(run_all())
+
+    def close(self):
+        self.session.close()
@@ -13,6 +13,8 @@ LOG_FILE_PATH = Path(os.getenv("API_USAGE_LOG", "api_usage.jsonl"))
 _log_queue: Optional[queue.Queue] = None
 _log_thread: Optional[threading.Thread] = None
 _stop_event = threading.Event()
+# Sinks draining in parallel log at the same time, only one of them starts the thread
+_log_lock = threading.Lock()
 
 def _log_writer():
     """Background thread that writes logs to file."""
@@ -33,12 +35,13 @@ def _ensure_log_thread():
     """Ensure the logging thread is running."""
     global _log_queue, _log_thread
 
-    if _log_queue is None:
-        _log_queue = queue.Queue()
+    with _log_lock:
+        if _log_queue is None:
+            _log_queue = queue.Queue()
 
-    if _log_thread is None or not _log_thread.is_alive():
-        _log_thread = threading.Thread(target=_log_writer, daemon=True)
-        _log_thread.start()
+        if _log_thread is None or not _log_thread.is_alive():
+            _log_thread = threading.Thread(target=_log_writer, daemon=True)
+            _log_thread.start()
 
 def save_api_usage(method, url, params, body, response, stream=None):
     _ensure_log_thread()